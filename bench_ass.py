@@ -0,0 +1,86 @@
+"""
+So sánh kích thước file .ass và thời gian render libass của từng mode phụ đề (bản cũ vs compact).
+
+    python bench_ass.py --minutes 10 --words-per-line 5
+
+Render dùng cùng filter "ass=...:fontsdir=fonts" như burn_sub_and_audio, trên nền màu lavfi (không encode, -f null).
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from subtitle_track import SubtitleTrack
+
+
+def make_track(minutes, words_per_line, seed=0):
+    """Phụ đề giả: từ dài 0.2-0.6s, mỗi dòng words_per_line từ (giống split_text_and_timestamps)."""
+    rng = random.Random(seed)
+    track = SubtitleTrack()
+    t = 0.0
+    line = []
+    while t < minutes * 60:
+        dur = rng.uniform(0.2, 0.6)
+        text = " " + "".join(rng.choice("abcdeghiklmnopqrstuvxy") for _ in range(rng.randint(2, 7)))
+        track.add_word(t, t + dur, text, "word")
+        line.append((t, t + dur, text))
+        t += dur
+        if len(line) == words_per_line:
+            track.add_line(line[0][0], line[-1][1], "".join(w[2] for w in line).strip())
+            line = []
+    return track
+
+
+def render_seconds(ass_path, duration, size="1080x1920"):
+    if not shutil.which("ffmpeg"):
+        return None
+    ass_safe = ass_path.replace("\\", "/").replace(":", "\\\\:").replace("'", "\\'")
+    cmd = [
+        "ffmpeg", "-v", "error", "-f", "lavfi", "-i", f"color=c=black:s={size}:r=30:d={duration}",
+        "-vf", f"ass={ass_safe}:fontsdir=fonts", "-f", "null", "-"
+    ]
+    start = time.time()
+    subprocess.run(cmd, check=True)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark encoding phụ đề .ass")
+    parser.add_argument("--minutes", type=float, default=5)
+    parser.add_argument("--words-per-line", type=int, default=5)
+    parser.add_argument("--render-seconds", type=float, default=60, help="Số giây video render để đo libass (0 = bỏ qua)")
+    parser.add_argument("--size", default="1080x1920")
+    args = parser.parse_args()
+
+    import voice_google
+
+    track = make_track(args.minutes, args.words_per_line)
+    modes = ["Phụ đề thường (toàn câu)", "Highlight từng từ (karaoke)"] + list(voice_google.SEQUENTIAL_HIGHLIGHT_MODES)
+    workdir = tempfile.mkdtemp(prefix="bench_ass_")
+
+    print(f"🧪 {len(track.lines)} dòng / {len(track.words)} từ ({args.minutes} phút)")
+    print(f"{'mode':<32} {'encoding':<8} {'events':>7} {'KB':>9} {'gen s':>7} {'render s':>9}")
+    for mode in modes:
+        encodings = ["legacy", "compact"] if mode in voice_google.SEQUENTIAL_HIGHLIGHT_MODES else ["legacy"]
+        for encoding in encodings:
+            ass_path = os.path.join(workdir, f"{len(os.listdir(workdir))}.ass")
+            start = time.time()
+            voice_google.generate_karaoke_ass(track, ass_path, size=14, mode=mode,
+                                              compact=encoding == "compact")
+            gen_seconds = time.time() - start
+            ass_path = voice_google.sanitize_path(ass_path)
+            with open(ass_path, encoding="utf-8") as f:
+                events = sum(1 for line in f if line.startswith("Dialogue:"))
+            rendered = render_seconds(ass_path, args.render_seconds, args.size) if args.render_seconds else None
+            rendered = f"{rendered:.2f}" if rendered is not None else "-"
+            print(f"{mode:<32} {encoding:<8} {events:>7} {os.path.getsize(ass_path) / 1024:>9.1f} "
+                  f"{gen_seconds:>7.2f} {rendered:>9}")
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
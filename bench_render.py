@@ -0,0 +1,69 @@
+"""
+So sánh render 1 lượt (render_video_fused) với render nhiều bước (segment -> concat -> burn phụ đề + audio).
+
+    python bench_render.py --media media_folder --audio voice.mp3 --ass sub.ass
+    python bench_render.py --media media_folder --audio voice.mp3 --horizontal --no-crop
+
+Cả 2 cách dùng cùng random seed nên chọn cùng media và cùng hiệu ứng chuyển cảnh. Cần ffmpeg trong PATH.
+Cache segment bị tắt để cách nhiều bước luôn encode lại segment (thêm --segment-cache để đo khi có cache).
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark render video 1 lượt vs nhiều bước")
+    parser.add_argument("--media", required=True, help="Thư mục ảnh / video nền")
+    parser.add_argument("--audio", required=True, help="File voice")
+    parser.add_argument("--ass", help="File phụ đề .ass (mặc định: không phụ đề)")
+    parser.add_argument("--music", help="File nhạc nền")
+    parser.add_argument("--volume", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--horizontal", action="store_true")
+    parser.add_argument("--no-crop", action="store_true")
+    parser.add_argument("--segment-cache", action="store_true", help="Dùng cache segment (mặc định: tắt khi đo)")
+    args = parser.parse_args()
+
+    if not shutil.which("ffmpeg"):
+        print("❌ Không tìm thấy ffmpeg")
+        return
+
+    import video_creator
+    video_creator.SEGMENT_CACHE_ENABLED = args.segment_cache
+
+    media_files = [
+        os.path.join(args.media, f)
+        for f in sorted(os.listdir(args.media))
+        if f.lower().endswith((".jpg", ".png", ".mp4", ".mov"))
+    ]
+    workdir = tempfile.mkdtemp(prefix="bench_render_")
+
+    print(f"🧪 {len(media_files)} file media, audio: {args.audio}")
+    print(f"{'cách render':<12} {'giây':>8} {'MB':>8}")
+    for mode in ["fused", "multi"]:
+        output_path = os.path.join(workdir, f"{mode}.mp4")
+        random.seed(args.seed)
+        start = time.time()
+        try:
+            used = video_creator.render_video(media_files, args.audio, output_path,
+                                              os.path.join(workdir, "temp_video.mp4"),
+                                              ass_path=args.ass, is_vertical=not args.horizontal,
+                                              crop=not args.no_crop, bg_music_path=args.music,
+                                              bg_music_volume=args.volume, fused=mode == "fused")
+        except Exception as e:
+            print(f"{mode:<12} ❌ {e}")
+            continue
+        seconds = time.time() - start
+        if used != mode:
+            print(f"⚠️ {mode}: đã chuyển sang {used}")
+        print(f"{mode:<12} {seconds:>8.2f} {os.path.getsize(output_path) / 1024 / 1024:>8.1f}")
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
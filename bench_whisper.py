@@ -0,0 +1,99 @@
+"""
+Tìm cấu hình whisper (compute_type / cpu_threads / num_workers) nhanh nhất trên máy hiện tại.
+
+    python bench_whisper.py --model small --jobs 5
+    python bench_whisper.py --audio reference.wav --compute-types int8 float32
+
+Mỗi cấu hình transcribe cùng 1 đoạn audio mẫu bằng --jobs thread song song (giống số job của GUI),
+cấu hình có throughput cao nhất được ghi vào whisper_config.json và thành mặc định cho transcribe trong GUI.
+Không truyền --audio thì tạo audio mẫu bằng TTS từ REFERENCE_TEXT (lần sau lấy lại từ TTS cache).
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+REFERENCE_TEXT = (
+    "Xin chào các bạn, hôm nay chúng ta sẽ cùng tìm hiểu cách làm một video ngắn thật nhanh. "
+    "Đầu tiên, hãy chuẩn bị kịch bản rõ ràng, mỗi câu nên ngắn gọn và dễ hiểu. "
+    "Tiếp theo, chọn giọng đọc phù hợp với nội dung và thêm nhạc nền nhẹ nhàng. "
+    "Cuối cùng, kiểm tra phụ đề thật kỹ trước khi đăng video lên mạng xã hội nhé."
+)
+
+
+def thread_layouts(jobs):
+    """Các cặp (cpu_threads, num_workers) hợp lý cho `jobs` transcribe chạy cùng lúc."""
+    cpus = os.cpu_count() or 4
+    per_job = max(1, cpus // jobs)
+    layouts = [(0, 1), (0, jobs), (per_job, jobs), (1, jobs), (cpus, 1)]
+    return list(dict.fromkeys(layouts))
+
+
+def run_config(voice_google, audio, model_name, device, settings, jobs, language):
+    # Load model trước để không tính thời gian load vào kết quả
+    voice_google.get_whisper_model(model_name, device, settings["compute_type"],
+                                   settings["cpu_threads"], settings["num_workers"])
+
+    # use_cache=False: transcript cache không phân biệt cpu_threads / num_workers, job sau sẽ chỉ đọc cache
+    def job(_):
+        voice_google.transcribe_audio(audio, None, language_code=language, model_name=model_name, device=device,
+                                      export_files=False, use_cache=False, **settings)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(job, range(jobs)))
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cấu hình whisper và lưu cấu hình nhanh nhất")
+    parser.add_argument("--audio", help="File audio mẫu (mặc định: tạo bằng TTS từ REFERENCE_TEXT)")
+    parser.add_argument("--model", default="small")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--language", default="vi")
+    parser.add_argument("--jobs", type=int, default=5, help="Số job transcribe chạy cùng lúc (MAX_THREADS của GUI)")
+    parser.add_argument("--compute-types", nargs="+", default=["int8", "int8_float32", "float32"])
+    parser.add_argument("--no-save", action="store_true", help="Chỉ in kết quả, không ghi whisper_config.json")
+    args = parser.parse_args()
+
+    import voice_google
+
+    audio = args.audio
+    if not audio:
+        api_keys = voice_google.fetch_api_keys()
+        audio = voice_google.create_voice_audio(REFERENCE_TEXT, api_keys)
+        print(f"🎤 Audio mẫu: {audio.duration:.1f}s")
+
+    compute_types = voice_google.whisper_compute_types(args.device)
+    skipped = [t for t in args.compute_types if t not in compute_types]
+    if skipped:
+        print(f"⚠️ Bỏ qua {skipped}: không chạy được trên {args.device}")
+
+    results = []
+    print(f"{'compute_type':<14} {'threads':>7} {'workers':>7} {'giây':>8} {'job/phút':>9}")
+    for compute_type in [t for t in args.compute_types if t in compute_types]:
+        for cpu_threads, num_workers in thread_layouts(args.jobs):
+            settings = {"compute_type": compute_type, "cpu_threads": cpu_threads, "num_workers": num_workers}
+            try:
+                seconds = run_config(voice_google, audio, args.model, args.device, settings, args.jobs, args.language)
+            except Exception as e:
+                print(f"{compute_type:<14} {cpu_threads:>7} {num_workers:>7} ❌ {e}")
+                continue
+            results.append((seconds, settings))
+            print(f"{compute_type:<14} {cpu_threads:>7} {num_workers:>7} {seconds:>8.2f} "
+                  f"{args.jobs * 60 / seconds:>9.1f}")
+
+    if not results:
+        print("❌ Không có cấu hình nào chạy được")
+        return
+
+    seconds, best = min(results, key=lambda item: item[0])
+    print(f"🏆 Nhanh nhất: {best} ({seconds:.2f}s cho {args.jobs} job)")
+    if not args.no_save:
+        voice_google.save_whisper_settings(best)
+        print(f"💾 Đã lưu vào {voice_google.WHISPER_SETTINGS_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import os
+import threading
+from contextlib import contextmanager
+
+
+# Tiện ích dùng chung cho các cache trên đĩa (TTS, transcript, segment video)
+
+
+def evict_cache_dir(cache_dir, max_bytes, keep=()):
+    """
+    Xóa các file ít dùng nhất (mtime cũ nhất) cho tới khi thư mục cache nhỏ hơn giới hạn.
+    Các đường dẫn trong keep (đang được job khác dùng) không bị xóa, kể cả khi vẫn vượt giới hạn.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue  # Vẫn tính vào tổng dung lượng nhưng không xóa
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass  # File đang được đọc bởi job khác
+
+
+class KeyLocks:
+    """Mỗi key 1 lock: các job cùng key chờ nhau (job đầu tạo dữ liệu, job sau đọc cache), khác key chạy song song."""
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}  # key -> [lock, số thread đang giữ hoặc chờ]
+
+    @contextmanager
+    def hold(self, key):
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]  # Không còn ai dùng key này -> không giữ lock mãi trong dict
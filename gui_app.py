@@ -9,10 +9,15 @@ from PyQt5.QtWidgets import (
     QHBoxLayout, QComboBox, QHeaderView, QGroupBox, QPlainTextEdit
 )
 from PyQt5.QtCore import Qt, QMetaObject, Q_ARG, pyqtSlot
-from PyQt5.QtGui import QFont
-from pydub import AudioSegment
-from voice_google import transcribe_audio, generate_karaoke_ass_from_srt_and_words, fetch_api_keys, create_voice_with_retry
-from video_creator import create_video_randomized_media, burn_sub_and_audio
+from PyQt5.QtGui import QFont, QIntValidator
+from voice_google import (
+    transcribe_audio, generate_karaoke_ass, fetch_api_keys,
+    preload_whisper_model, get_tts_cache_stats, create_voice_chunked, create_voice_audio, key_scheduler,
+    get_tts_attempt_stats, get_transcript_cache_stats, load_whisper_settings, detect_language, script_decode_options,
+    LanguagePin, LANGUAGES_URL, whisper_compute_types
+)
+from video_creator import render_video
+from script_align import align_script, ALIGN_MIN_CONFIDENCE
 
 
 def wait_for_file(filepath, timeout=10):
@@ -26,7 +31,7 @@ def wait_for_file(filepath, timeout=10):
 
 def fetch_languages():
     try:
-        response = requests.get("http://62.171.131.164:5000/api/get_gemini_languages", timeout=5)
+        response = requests.get(LANGUAGES_URL, timeout=5)
         if response.ok:
             return response.json().get("languages", [])
     except Exception as e:
@@ -54,6 +59,20 @@ def safe_remove_file(file_path, log_func=None, retries=3, delay=0.5):
 
 
 MAX_THREADS = 5
+PRELOAD_WHISPER_MODEL = True  # Load model whisper trong lúc đang tạo voice
+TTS_CHUNKED_MODE = False  # Tạo voice song song theo từng cụm câu (cho script dài)
+TTS_CHUNK_PAUSE = 0.15  # Khoảng lặng (giây) giữa các chunk
+TTS_ASYNC_CLIENT = False  # Dùng client asyncio chung (tts_async, cần aiohttp) thay vì thread cho mỗi job
+VOICE_COMPACT_SILENCE = False  # Cắt lặng 2 đầu voice và rút quãng nghỉ dài -> video, whisper, render đều ngắn hơn
+VOICE_MAX_PAUSE = 0.5  # Quãng nghỉ dài nhất (giây) được giữ lại giữa các câu
+VOICE_SILENCE_DB = -40.0  # Ngưỡng năng lượng (dBFS) coi là lặng
+TRANSCRIBE_WORKER_PROCESSES = 0  # > 0: transcribe ở N process riêng (transcribe_service), 0 = ngay trong thread của job
+TRANSCRIBE_BATCH_JOBS = 0  # > 0: gom tối đa N job đã có voice vào 1 lần batched inference (transcribe_batch)
+TRANSCRIBE_CHUNK_WORKERS = 1  # > 1: voice dài được chia chunk tại khoảng lặng và transcribe song song
+PIN_BATCH_LANGUAGE = True  # "Auto Detect": nhận diện ngôn ngữ 1 lần cho cả batch rồi ghim cho các job sau
+WHISPER_SCRIPT_PROMPT = True  # Đưa kịch bản cho whisper làm initial_prompt + hotwords (ít phải decode lại)
+SUBTITLE_TIMING_MODE = "whisper"  # "script": căn thời gian theo kịch bản (script_align), whisper chỉ chạy khi độ tin cậy thấp
+RENDER_FUSED = True  # Media + phụ đề + audio encode 1 lượt (render_video_fused), lỗi thì quay về render nhiều bước
 
 
 class VideoGeneratorApp(QWidget):
@@ -303,9 +322,40 @@ class VideoGeneratorApp(QWidget):
         self.model_selector.addItems(["tiny", "base", "small", "medium", "large"])
         model_layout.addWidget(self.model_selector)
 
+        # Cấu hình CTranslate2 (mặc định lấy từ whisper_config.json do bench_whisper.py tạo)
+        whisper_settings = load_whisper_settings()
+        compute_layout = QHBoxLayout()
+        compute_layout.addWidget(QLabel("🔢 Compute:"))
+        self.compute_type_selector = QComboBox()
+        self.update_compute_types()
+        self.compute_type_selector.setCurrentText(whisper_settings["compute_type"])
+        self.cpu_selector.currentTextChanged.connect(self.update_compute_types)
+        compute_layout.addWidget(self.compute_type_selector)
+
+        threads_layout = QHBoxLayout()
+        threads_layout.addWidget(QLabel("🧵 Threads:"))
+        self.cpu_threads_selector = QComboBox()
+        self.cpu_threads_selector.addItems(["0", "1", "2", "4", "8", "16"])  # 0 = mặc định của CTranslate2
+        self.cpu_threads_selector.setEditable(True)
+        self.cpu_threads_selector.setValidator(QIntValidator(0, 256, self))  # Chỉ cho nhập số
+        self.cpu_threads_selector.setCurrentText(str(whisper_settings["cpu_threads"]))
+        threads_layout.addWidget(self.cpu_threads_selector)
+
+        workers_layout = QHBoxLayout()
+        workers_layout.addWidget(QLabel("👷 Workers:"))
+        self.num_workers_selector = QComboBox()
+        self.num_workers_selector.addItems([str(i) for i in range(1, MAX_THREADS + 1)])
+        self.num_workers_selector.setEditable(True)
+        self.num_workers_selector.setValidator(QIntValidator(1, 64, self))
+        self.num_workers_selector.setCurrentText(str(whisper_settings["num_workers"]))
+        workers_layout.addWidget(self.num_workers_selector)
+
         # Combine both layouts into the main layout for CPU/GPU and Model selection
         cpu_model_layout.addLayout(cpu_layout)
         cpu_model_layout.addLayout(model_layout)
+        cpu_model_layout.addLayout(compute_layout)
+        cpu_model_layout.addLayout(threads_layout)
+        cpu_model_layout.addLayout(workers_layout)
 
         # Set the layout for the group box and add it to the main layout
         cpu_model_group.setLayout(cpu_model_layout)
@@ -408,6 +458,14 @@ class VideoGeneratorApp(QWidget):
         else:
             self.crop_checkbox.setText("🖼️ Crop: OFF")
 
+    def update_compute_types(self):
+        """Chỉ hiện compute_type chạy được trên thiết bị đang chọn (float16 cần GPU)."""
+        use_gpu = self.cpu_selector.currentText() == "GPU" and torch.cuda.is_available()
+        current = self.compute_type_selector.currentText()
+        self.compute_type_selector.clear()
+        self.compute_type_selector.addItems(whisper_compute_types("cuda" if use_gpu else "cpu"))
+        self.compute_type_selector.setCurrentText(current)  # Giữ lựa chọn cũ nếu vẫn hợp lệ
+
 
 
     def __init__(self):
@@ -563,6 +621,7 @@ class VideoGeneratorApp(QWidget):
 
         self.jobs_completed = 0
         self.total_jobs = total_jobs
+        self.language_pin = LanguagePin()  # Ngôn ngữ "Auto Detect" dùng chung cho batch này
 
         executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS)
         futures = []
@@ -575,12 +634,28 @@ class VideoGeneratorApp(QWidget):
             device = "cpu"  # Default to CPU
 
         selected_model = self.model_selector.currentText()  # "tiny", "base", "small", "medium", "large"
+        whisper_options = {
+            "compute_type": self.compute_type_selector.currentText(),
+            "cpu_threads": int(self.cpu_threads_selector.currentText() or 0),
+            # Giống stream_transcription: num_workers >= TRANSCRIBE_CHUNK_WORKERS, để preload / nhận diện ngôn ngữ /
+            # transcribe đều dùng đúng 1 model trong registry
+            "num_workers": max(1, int(self.num_workers_selector.currentText() or 1), TRANSCRIBE_CHUNK_WORKERS)
+        }
         subtitles_enabled = self.subtitle_enabled_selector.currentText() == "Có phụ đề"
 
 
         def update_progress_and_check(future):
             self.jobs_completed += 1
             if self.jobs_completed == self.total_jobs:
+                for key, key_stats in key_scheduler.stats().items():
+                    self.safe_append_log(
+                        f"🔑 Key {key}...: dùng {key_stats['used']} lần, bị từ chối {key_stats['rejected']} lần"
+                    )
+                tts_stats = get_tts_attempt_stats()
+                self.safe_append_log(
+                    f"📡 TTS: {tts_stats['requests']} voice, {tts_stats['attempts_per_request']} request/voice, "
+                    f"{tts_stats['hedged']} hedge, p50={tts_stats['p50'] or 0:.1f}s, p95={tts_stats['p95'] or 0:.1f}s"
+                )
                 self.generate_btn.setEnabled(True)
                 self.generate_btn.setText("🚀 Tạo Video")
 
@@ -588,12 +663,15 @@ class VideoGeneratorApp(QWidget):
         for idx, text in enumerate(self.text_list):
             output_filename = os.path.join(self.output_folder, f"video_{idx+1}.mp4")
             self.add_table_row(idx, text)
-            future = executor.submit(self.run_video_job, text, self.folder_path, output_filename, api_key_list, idx, device, selected_model, subtitles_enabled)
+            future = executor.submit(self.run_video_job, text, self.folder_path, output_filename, api_key_list, idx, device, selected_model, subtitles_enabled, whisper_options)
             future.add_done_callback(update_progress_and_check)
 
 
 
-    def run_video_job(self, text, folder_path, output_path, api_key_list, index, device, model_name, subtitles_enabled):
+    def run_video_job(self, text, folder_path, output_path, api_key_list, index, device, model_name, subtitles_enabled,
+                      whisper_options=None):
+        whisper_options = whisper_options or {}
+
         def log(msg):
             self.safe_append_log(f"[Video #{index + 1}] {msg}")
 
@@ -608,6 +686,19 @@ class VideoGeneratorApp(QWidget):
         if not voice_id:
             voice_id = "achird"  # Default voice in case no voice is selected
 
+        transcription_service = None
+        if TRANSCRIBE_WORKER_PROCESSES:
+            # Các process worker load model ngay khi khởi động, trong lúc job đang tạo voice
+            from transcribe_service import get_transcription_service
+            transcription_service = get_transcription_service(
+                TRANSCRIBE_WORKER_PROCESSES, model_name=model_name, device=device,
+                compute_type=whisper_options.get("compute_type", "default"),
+                cpu_threads=whisper_options.get("cpu_threads", 0)
+            )
+        elif PRELOAD_WHISPER_MODEL and SUBTITLE_TIMING_MODE != "script":
+            # Mode "script" căn theo kịch bản, whisper chỉ chạy khi độ tin cậy thấp -> load lúc cần
+            preload_whisper_model(model_name, device, **whisper_options)
+
         try:
             log(f"🎤 Đang tạo giọng với Voice ID: {voice_id}")
 
@@ -621,8 +712,29 @@ class VideoGeneratorApp(QWidget):
                     log(f"⚠️ Không thể xoá file tạm {f}: {cleanup_err}")
 
             # Generate audio with retry
-            audio_file = create_voice_with_retry(text, audio_file, api_key_list, voice_name=voice_id)
-            log("📝 Tạo giọng và lưu file audio thành công")
+            # Voice được giữ dạng PCM trong RAM (VoiceAudio) cho mọi bước phía sau
+            if TTS_CHUNKED_MODE:
+                voice_result = create_voice_chunked(text, audio_file, api_key_list, voice_name=voice_id,
+                                                    pause=TTS_CHUNK_PAUSE, save_mp3=False)
+                voice_audio = voice_result["audio"]
+                log(f"✂️ Đã ghép {len(voice_result['chunks'])} chunk voice")
+            elif TTS_ASYNC_CLIENT:
+                from tts_async import create_voice_audio as create_voice_audio_async
+                voice_audio = create_voice_audio_async(text, api_key_list, voice_name=voice_id)
+                cache_stats = get_tts_cache_stats()
+                log(f"💾 TTS cache: {cache_stats['hit']} hit / {cache_stats['miss']} miss")
+            else:
+                voice_audio = create_voice_audio(text, api_key_list, voice_name=voice_id)
+                cache_stats = get_tts_cache_stats()
+                log(f"💾 TTS cache: {cache_stats['hit']} hit / {cache_stats['miss']} miss")
+            log("📝 Tạo giọng thành công")
+
+            if VOICE_COMPACT_SILENCE:
+                original_duration = voice_audio.duration
+                voice_audio, timing_map = voice_audio.compact_silence(threshold_db=VOICE_SILENCE_DB,
+                                                                      max_pause=VOICE_MAX_PAUSE)
+                log(f"✂️ Rút gọn khoảng lặng: {original_duration:.2f}s -> {voice_audio.duration:.2f}s "
+                    f"({len(timing_map.segments)} đoạn)")
 
             language_code = self.language_selector.currentData()
 
@@ -631,17 +743,82 @@ class VideoGeneratorApp(QWidget):
             else:
                 log("🗣️ Đang sử dụng chế độ Auto Detect")
 
-            log("🧠 Đang dùng fast-whisper để tạo phụ đề...")
-            trans_result = transcribe_audio(
-                audio_path=audio_file,
-                folder_path=self.output_folder,
-                output_base=f"video_{index + 1}",
-                language_code=language_code,
-                model_name=model_name,  # Use the selected model
-                device=device  # Use CPU/GPU
-            )
-            sub_file = trans_result["srt_path"]
-            karaoke_json = trans_result["karaoke_path"]
+            next_report = 0.25
+
+            def report_transcribe_progress(item):
+                # Báo tiến độ mỗi 25% trong lúc whisper vẫn đang decode
+                nonlocal next_report
+                if item["progress"] >= next_report:
+                    log(f"🧠 Phụ đề: {int(item['progress'] * 100)}%")
+                    while next_report <= item["progress"]:
+                        next_report += 0.25
+
+            def run_whisper():
+                nonlocal language_code
+                log("🧠 Đang dùng fast-whisper để tạo phụ đề...")
+                if language_code is None and PIN_BATCH_LANGUAGE:
+                    if transcription_service:
+                        # Nhận diện ở process worker, process GUI không phải load model
+                        detect = lambda: transcription_service.detect_language(voice_audio).result()
+                    else:
+                        detect = lambda: detect_language(voice_audio, model_name, device, **whisper_options)
+                    language_code = self.language_pin.resolve(detect)
+                    log(f"🗣️ Ngôn ngữ ghim cho batch: {language_code}")
+                decode_options = script_decode_options(text) if WHISPER_SCRIPT_PROMPT else None
+
+                whisper_start = time.time()
+                if TRANSCRIBE_BATCH_JOBS and not transcription_service:
+                    from transcribe_batch import get_batch_transcriber
+                    if decode_options:
+                        # 1 lần batched decode chung cho nhiều job -> không có initial_prompt / hotwords riêng từng job
+                        log("⚠️ Batched transcribe không hỗ trợ gợi ý kịch bản (initial_prompt / hotwords), bỏ qua")
+                    batcher = get_batch_transcriber(TRANSCRIBE_BATCH_JOBS, model_name=model_name, device=device,
+                                                    **whisper_options)
+                    batch_subtitles = batcher.submit(voice_audio, language_code).result()
+                    log(f"⏱️ Whisper (batched, gồm thời gian chờ gom batch): {time.time() - whisper_start:.1f}s, "
+                        f"ngôn ngữ {language_code or 'auto'}, {len(batch_subtitles.lines)} dòng")
+                    return batch_subtitles
+                if transcription_service:
+                    trans_result = transcription_service.transcribe(
+                        voice_audio, language_code,
+                        on_progress=lambda progress: report_transcribe_progress({"progress": progress}),
+                        decode_options=decode_options
+                    ).result()
+                    log(f"⏱️ Whisper (worker process): {trans_result['seconds']:.1f}s decode, "
+                        f"{time.time() - whisper_start:.1f}s tổng, ngôn ngữ {trans_result['language']}, "
+                        f"{trans_result['fallbacks']} segment phải decode lại (temperature fallback)")
+                    return trans_result["subtitles"]
+                trans_result = transcribe_audio(
+                    audio_path=voice_audio,
+                    folder_path=self.output_folder,
+                    output_base=f"video_{index + 1}",
+                    language_code=language_code,
+                    model_name=model_name,  # Use the selected model
+                    device=device,  # Use CPU/GPU
+                    on_segment=report_transcribe_progress,
+                    **whisper_options,
+                    chunk_workers=TRANSCRIBE_CHUNK_WORKERS,
+                    decode_options=decode_options,
+                    export_files=False  # Phụ đề giữ trong RAM, không ghi .srt / .json trung gian
+                )
+                log(f"⏱️ Whisper: {trans_result['seconds']:.1f}s, ngôn ngữ {trans_result['language']}, "
+                    f"{trans_result['fallbacks']} segment phải decode lại (temperature fallback)")
+                return trans_result["subtitles"]
+
+            subtitles = None
+            if SUBTITLE_TIMING_MODE == "script":
+                # Đã biết chính xác nội dung đọc -> căn thời gian theo kịch bản, không cần whisper
+                subtitles, confidence = align_script(text, voice_audio)
+                if confidence >= ALIGN_MIN_CONFIDENCE:
+                    log(f"📐 Căn phụ đề theo kịch bản: {len(subtitles.lines)} dòng (độ tin cậy {confidence:.2f})")
+                else:
+                    log(f"⚠️ Độ tin cậy căn kịch bản thấp ({confidence:.2f}), chuyển sang whisper")
+                    subtitles = None
+            if subtitles is None:
+                subtitles = run_whisper()
+
+            transcript_stats = get_transcript_cache_stats()
+            log(f"💾 Transcript cache: {transcript_stats['hit']} hit / {transcript_stats['miss']} miss")
 
             log("✨ Đang tạo file karaoke .ass từ fast-whisper...")
             ass_file = os.path.join(self.output_folder, f"video_{index + 1}.ass")
@@ -655,9 +832,8 @@ class VideoGeneratorApp(QWidget):
             background_music = self.music_selector.currentText()
 
             if subtitles_enabled:
-                generate_karaoke_ass_from_srt_and_words(
-                    sub_file,
-                    karaoke_json,
+                generate_karaoke_ass(
+                    subtitles,
                     ass_file,
                     font=font_name,
                     size=int(font_size),
@@ -670,7 +846,7 @@ class VideoGeneratorApp(QWidget):
             else:
                 ass_file = None  # No subtitles if disabled
 
-            duration = AudioSegment.from_file(audio_file).duration_seconds
+            duration = voice_audio.duration
             log(f"⏳ Độ dài audio: {duration:.2f} giây")
 
             media_files = [
@@ -688,19 +864,6 @@ class VideoGeneratorApp(QWidget):
             crop_enabled = self.crop_checkbox.isChecked()
             log(f"✂️ Crop mode: {'ON' if crop_enabled else 'OFF'}")
 
-            create_video_randomized_media(
-                media_files=media_files,
-                total_duration=duration,
-                change_every=5,
-                word_count=len(text.split()),
-                output_file=temp_video,
-                is_vertical=is_vertical,
-                crop=crop_enabled
-            )
-
-            log("🎞️ Tạo video nền hoàn tất")
-
-          
             music_path = os.path.join("background_music", background_music)
             if not os.path.exists(music_path) or background_music == "Không có nhạc nền":
                 music_path = None
@@ -715,24 +878,27 @@ class VideoGeneratorApp(QWidget):
                 music_volume = 30
             log(f"🔊 Âm lượng nhạc nền: {music_volume}%")
 
-            log(f"⏳ Chờ file video sẵn sàng: {temp_video}")
-            wait_for_file(temp_video)
-
-
             # Render final video with subtitles and background audio
-            burn_sub_and_audio(
-                video_path=temp_video,
-                srt_path=ass_file,
-                voice_path=audio_file,
-                output_path=output_path,
+            render_start = time.time()
+            render_mode = render_video(
+                media_files,
+                voice_audio,
+                output_path,
+                temp_video,
+                ass_path=ass_file,
+                is_vertical=is_vertical,
+                crop=crop_enabled,
+                bg_music_path=music_path,
+                bg_music_volume=music_volume,
                 font_name=font_name,
                 font_size=font_size,
                 font_color="&H00" + base_hex,
-                bg_music_path=music_path,
-                bg_music_volume=music_volume
+                word_count=len(text.split()),
+                fused=RENDER_FUSED
             )
 
-            log("🎬 Video cuối cùng đã được render và lưu")
+            log(f"🎬 Video cuối cùng đã được render và lưu ({'1 lượt' if render_mode == 'fused' else 'nhiều bước'}, "
+                f"{time.time() - render_start:.1f}s)")
             self.safe_update_status(index, "✅ Hoàn thành")
 
         except Exception as e:
@@ -741,9 +907,8 @@ class VideoGeneratorApp(QWidget):
             return
 
         # Xóa file tạm sau khi xong
-        for f in [ass_file, karaoke_json]:
-            safe_remove_file(f, log_func=log)
-        for f in [audio_file, sub_file, temp_video]:
-            safe_remove_file(f, log_func=log)
+        for f in [ass_file, audio_file, sub_file, temp_video]:
+            if f:
+                safe_remove_file(f, log_func=log)
 
           
@@ -0,0 +1,117 @@
+"""
+Đo throughput và độ trễ của bước TTS với nhiều job chạy song song (offline, dùng mock_server.py).
+
+    python load_test.py --jobs 200 --concurrency 10 50 200 500 --client hedged fanout async
+
+Nếu không truyền --server, script tự khởi động mock server trong process.
+"""
+import argparse
+import os
+import time
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * (len(values) - 1) + 0.5))]
+
+
+def run_sync(voice_google, texts, api_keys, concurrency, strategy):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def job(text):
+        start = time.time()
+        try:
+            voice_google.synthesize_pcm(text, api_keys, strategy=strategy)
+            return time.time() - start, True
+        except Exception:
+            return time.time() - start, False
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(job, texts))
+
+
+def run_async(texts, api_keys, concurrency):
+    import asyncio
+    import tts_async
+
+    client = tts_async.get_tts_client()
+
+    async def job(text, limit):
+        async with limit:
+            start = time.time()
+            try:
+                await client.synthesize_pcm(text, api_keys)
+                return time.time() - start, True
+            except Exception:
+                return time.time() - start, False
+
+    async def main():
+        limit = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*(job(text, limit) for text in texts))
+
+    return client.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test bước TTS")
+    parser.add_argument("--server", help="URL mock server có sẵn (mặc định: tự khởi động)")
+    parser.add_argument("--jobs", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--client", nargs="+", default=["hedged", "async"], choices=["hedged", "fanout", "async"])
+    parser.add_argument("--chars", type=int, default=300, help="Độ dài text mỗi job")
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--rate-limit", type=float, default=0.02)
+    parser.add_argument("--keys", type=int, default=10)
+    parser.add_argument("--key-rpm", type=int, default=600, help="Quota mỗi key trong KeyScheduler")
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.server
+    if not base_url:
+        from mock_server import MockConfig, start_mock_server
+        config = MockConfig(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                            rate_limit=args.rate_limit, retry_after=1, num_keys=args.keys)
+        server, base_url = start_mock_server(config)
+
+    # Phải đặt trước khi import voice_google để các URL trỏ về mock server
+    os.environ["CREATOR_API_SERVER"] = base_url
+    os.environ["GEMINI_API_BASE"] = f"{base_url}/v1beta/models"
+    import voice_google
+
+    voice_google.key_scheduler.rate = args.key_rpm / 60.0
+    voice_google.key_scheduler.burst = max(1, args.key_rpm // 60)
+    api_keys = voice_google.fetch_api_keys()
+    text = ("Xin chào các bạn, đây là đoạn văn bản dùng để đo tốc độ tạo giọng nói. " * 20)[:args.chars]
+
+    print(f"🧪 Server: {base_url} | {len(api_keys)} key | {args.jobs} job | {args.chars} ký tự/job")
+    print(f"{'client':<8} {'conc':>5} {'ok':>5} {'voice/s':>8} {'p50':>7} {'p95':>7} {'p99':>7} {'req/voice':>9}")
+    for client in args.client:
+        for concurrency in args.concurrency:
+            before = voice_google.get_tts_attempt_stats()
+            texts = [f"{i} {text}" for i in range(args.jobs)]
+            start = time.time()
+            if client == "async":
+                results = run_async(texts, api_keys, concurrency)
+            else:
+                results = run_sync(voice_google, texts, api_keys, concurrency, client)
+            elapsed = time.time() - start
+            after = voice_google.get_tts_attempt_stats()
+
+            latencies = [seconds for seconds, ok in results if ok]
+            ok_count = len(latencies)
+            requests_made = after["requests"] - before["requests"]
+            attempts = after["attempts"] - before["attempts"]
+            print(f"{client:<8} {concurrency:>5} {ok_count:>5} {ok_count / elapsed:>8.2f} "
+                  f"{percentile(latencies, 0.5):>7.2f} {percentile(latencies, 0.95):>7.2f} "
+                  f"{percentile(latencies, 0.99):>7.2f} {attempts / max(requests_made, 1):>9.2f}")
+
+    if server:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
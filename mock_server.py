@@ -0,0 +1,190 @@
+"""
+Server giả lập các API mà pipeline dùng (proxy, key, ngôn ngữ, Gemini TTS) để benchmark offline.
+
+    python mock_server.py --port 5055 --latency 1.5 --jitter 0.5 --error-rate 0.05 --rate-limit 0.1
+
+Sau đó trỏ app / load_test.py về server này:
+
+    CREATOR_API_SERVER=http://127.0.0.1:5055
+    GEMINI_API_BASE=http://127.0.0.1:5055/v1beta/models
+"""
+import argparse
+import base64
+import json
+import math
+import random
+import re
+import struct
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+SAMPLE_RATE = 24000
+SECONDS_PER_CHAR = 0.06  # Độ dài audio giả lập theo số ký tự của text
+
+
+def make_tone(seconds=1.0, freq=220.0):
+    """1 đoạn PCM s16le mono (sóng sin) dùng để ghép thành audio giả."""
+    frames = int(SAMPLE_RATE * seconds)
+    return b"".join(
+        struct.pack("<h", int(8000 * math.sin(2 * math.pi * freq * i / SAMPLE_RATE)))
+        for i in range(frames)
+    )
+
+
+TONE = make_tone()
+
+
+class MockConfig:
+    def __init__(self, latency=1.0, jitter=0.3, error_rate=0.0, rate_limit=0.0, key_rpm=0,
+                 retry_after=5, num_keys=10, proxies=None, languages=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit  # Xác suất trả 429 ngẫu nhiên
+        self.key_rpm = key_rpm  # Giới hạn request/phút của mỗi key (0 = không giới hạn)
+        self.retry_after = retry_after
+        self.keys = [f"MOCK-KEY-{i:04d}-xxxxxxxx" for i in range(num_keys)]
+        self.proxies = proxies or []
+        self.languages = languages or [
+            {"name": "Tiếng Việt", "code": "vi"},
+            {"name": "English", "code": "en"},
+        ]
+        self.key_hits = defaultdict(deque)
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        config = self.config
+        if self.path.startswith("/api/get_proxies"):
+            self._send_json(200, {"proxies": config.proxies})
+        elif self.path.startswith("/api/get_gemini_keys"):
+            self._send_json(200, {"keys": config.keys})
+        elif self.path.startswith("/api/get_gemini_languages"):
+            self._send_json(200, {"languages": config.languages})
+        elif self.path.startswith("/stats"):
+            with config.lock:
+                self._send_json(200, dict(config.counters))
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        config = self.config
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        if not re.match(r"^/v1beta/models/[^/:]+:generateContent", self.path):
+            self._send_json(404, {"error": "not found"})
+            return
+
+        api_key = self.headers.get("x-goog-api-key", "")
+        with config.lock:
+            config.counters["requests"] += 1
+            limited = random.random() < config.rate_limit
+            if config.key_rpm:
+                hits = config.key_hits[api_key]
+                now = time.time()
+                while hits and now - hits[0] > 60:
+                    hits.popleft()
+                if len(hits) >= config.key_rpm:
+                    limited = True
+                else:
+                    hits.append(now)
+            if limited:
+                config.counters["429"] += 1
+
+        if limited:
+            self._send_json(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}},
+                            headers={"Retry-After": str(config.retry_after)})
+            return
+
+        time.sleep(max(0.0, random.gauss(config.latency, config.jitter)))
+
+        if random.random() < config.error_rate:
+            with config.lock:
+                config.counters["500"] += 1
+            self._send_json(500, {"error": {"code": 500, "status": "INTERNAL"}})
+            return
+
+        try:
+            text = json.loads(raw)["contents"][0]["parts"][0]["text"]
+        except (ValueError, KeyError, IndexError):
+            self._send_json(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT"}})
+            return
+
+        seconds = max(0.5, len(text) * SECONDS_PER_CHAR)
+        whole, frac = divmod(seconds, 1.0)
+        pcm = TONE * int(whole) + TONE[:int(frac * SAMPLE_RATE) * 2]
+        with config.lock:
+            config.counters["200"] += 1
+        self._send_json(200, {
+            "candidates": [{
+                "content": {"parts": [{"inlineData": {
+                    "mimeType": f"audio/L16;codec=pcm;rate={SAMPLE_RATE}",
+                    "data": base64.b64encode(pcm).decode("ascii")
+                }}]}
+            }]
+        })
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # Chịu được vài trăm kết nối mở cùng lúc
+
+    def handle_error(self, request, client_address):
+        # Client hủy request thua (hedged / async) -> bỏ qua lỗi ngắt kết nối
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def start_mock_server(config=None, host="127.0.0.1", port=0):
+    """Chạy server ở thread nền, trả về (server, base_url)."""
+    handler = type("BoundMockHandler", (MockHandler,), {"config": config or MockConfig()})
+    server = MockServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Server giả lập API key/proxy/ngôn ngữ + Gemini TTS")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--latency", type=float, default=1.0, help="Độ trễ trung bình (giây)")
+    parser.add_argument("--jitter", type=float, default=0.3, help="Độ lệch chuẩn độ trễ (giây)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Tỉ lệ trả lỗi 500")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Tỉ lệ trả 429 ngẫu nhiên")
+    parser.add_argument("--key-rpm", type=int, default=0, help="Giới hạn request/phút mỗi key (0 = tắt)")
+    parser.add_argument("--retry-after", type=int, default=5)
+    parser.add_argument("--keys", type=int, default=10, help="Số key giả trả về")
+    args = parser.parse_args()
+
+    config = MockConfig(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        rate_limit=args.rate_limit, key_rpm=args.key_rpm, retry_after=args.retry_after,
+                        num_keys=args.keys)
+    server = MockServer((args.host, args.port), type("BoundMockHandler", (MockHandler,), {"config": config}))
+    print(f"🧪 Mock server chạy tại http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
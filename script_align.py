@@ -0,0 +1,138 @@
+import re
+from types import SimpleNamespace
+
+import numpy as np
+from pydub import AudioSegment
+
+from subtitle_track import SubtitleTrack
+from voice_audio import VoiceAudio
+from voice_google import SPLIT_PUNCTUATION, split_text_smart
+
+
+# Căn thời gian phụ đề theo đúng kịch bản đã gửi TTS, không cần chạy whisper
+ALIGN_FRAME_MS = 10
+ALIGN_MIN_PAUSE = 0.15  # Khoảng lặng ngắn hơn (giây) coi như vẫn đang nói
+ALIGN_SNAP_TOLERANCE = 0.8  # Giây: dấu câu chỉ được gắn vào khoảng lặng trong phạm vi này
+ALIGN_SIGNIFICANT_PAUSE = 0.3  # Khoảng lặng dài hơn mà không khớp dấu câu nào -> giảm độ tin cậy
+ALIGN_MIN_CONFIDENCE = 0.6  # Thấp hơn thì nên chạy whisper
+ALIGN_MAX_WORDS = 5  # Giống max_words của split_text_and_timestamps trong transcribe
+
+_VOWEL_GROUP_RE = re.compile(r"[aeiouyàáảãạăằắẳẵặâầấẩẫậèéẻẽẹêềếểễệìíỉĩịòóỏõọôồốổỗộơờớởỡợùúủũụưừứửữựỳýỷỹỵ]+",
+                             re.IGNORECASE)
+
+
+def syllable_weight(word):
+    """Ước lượng số âm tiết của 1 từ (nhóm nguyên âm; chữ số đọc thành ~1.5 âm tiết mỗi số)."""
+    digits = sum(ch.isdigit() for ch in word)
+    vowels = len(_VOWEL_GROUP_RE.findall(word))
+    return max(1.0, vowels + 1.5 * digits)
+
+
+def _runs(mask):
+    """Các đoạn liên tiếp True của mask: (starts, ends) theo chỉ số frame, end không tính."""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def voiced_frames(samples, sample_rate, frame_ms=ALIGN_FRAME_MS, min_pause=ALIGN_MIN_PAUSE):
+    """Mask frame có tiếng nói theo năng lượng, ngưỡng tự tính theo nền nhiễu / đỉnh của chính audio."""
+    frame_len = max(1, int(sample_rate * frame_ms / 1000))
+    n_frames = len(samples) // frame_len
+    if n_frames == 0:
+        return np.zeros(0, dtype=bool)  # Audio rỗng / ngắn hơn 1 frame -> align_script trả về độ tin cậy 0
+    frames = samples[:n_frames * frame_len].reshape(n_frames, frame_len).astype(np.float64)
+    db = 20 * np.log10(np.maximum(np.sqrt(np.mean(frames ** 2, axis=1)), 1e-10))
+    threshold = max(np.percentile(db, 10) + 10, np.percentile(db, 95) - 40)
+    voiced = db > threshold
+
+    # Lấp các quãng lặng quá ngắn (giữa 2 âm tiết) và bỏ các tiếng "tách" lẻ
+    starts, ends = _runs(~voiced)
+    min_gap = int(min_pause * 1000 / frame_ms)
+    for start, end in zip(starts, ends):
+        if end - start < min_gap and start > 0 and end < n_frames:
+            voiced[start:end] = True
+    starts, ends = _runs(voiced)
+    for start, end in zip(starts, ends):
+        if end - start < 5:
+            voiced[start:end] = False
+    return voiced
+
+
+def align_script(text, audio, max_words=ALIGN_MAX_WORDS):
+    """
+    Tính mốc thời gian từng từ / từng dòng của `text` trên `audio` (VoiceAudio hoặc đường dẫn file).
+    Trả về (SubtitleTrack, confidence 0..1). Dòng được tách giống split_text_and_timestamps.
+
+    Thời gian có tiếng được chia cho các từ theo số âm tiết, sau đó các dấu câu được neo vào
+    khoảng lặng gần nhất trong audio rồi nội suy tuyến tính giữa các điểm neo.
+    """
+    if not isinstance(audio, VoiceAudio):
+        audio = VoiceAudio.from_audio_segment(AudioSegment.from_file(audio))
+
+    parts = split_text_smart(SimpleNamespace(text=text), max_words)
+    tokens = [word for part in parts for word in part.split()]
+    track = SubtitleTrack()
+    if not tokens:
+        return track, 0.0
+
+    frame_s = ALIGN_FRAME_MS / 1000
+    voiced = voiced_frames(audio.to_samples(), audio.sample_rate)
+    cum_voiced = np.cumsum(voiced)
+    total_voiced = float(cum_voiced[-1]) if len(cum_voiced) else 0.0
+    if total_voiced == 0:
+        return track, 0.0
+
+    # Vị trí các khoảng lặng trên trục "thời gian có tiếng" (số frame có tiếng trước khoảng lặng)
+    gap_starts, gap_ends = _runs(~voiced)
+    inner = (gap_starts > 0) & (gap_ends < len(voiced))
+    gap_starts, gap_ends = gap_starts[inner], gap_ends[inner]
+    pause_pos = cum_voiced[gap_starts - 1].astype(np.float64)
+    pause_len = (gap_ends - gap_starts) * frame_s
+
+    weights = np.array([syllable_weight(word) for word in tokens])
+    bounds = np.concatenate(([0.0], np.cumsum(weights)))
+    bounds *= total_voiced / bounds[-1]
+
+    # Neo lần lượt các ranh giới sau dấu câu vào khoảng lặng gần vị trí dự kiến nhất
+    tolerance = ALIGN_SNAP_TOLERANCE / frame_s
+    anchor_from, anchor_to = [0.0], [0.0]
+    used = np.zeros(len(pause_pos), dtype=bool)
+    punct_bounds = [k for k in range(1, len(tokens)) if tokens[k - 1][-1] in SPLIT_PUNCTUATION]
+    for k in punct_bounds:
+        last_from, last_to = anchor_from[-1], anchor_to[-1]
+        scale = (total_voiced - last_to) / max(total_voiced - last_from, 1e-9)
+        expected = last_to + (bounds[k] - last_from) * scale
+        candidates = np.flatnonzero(~used & (pause_pos > last_to) & (np.abs(pause_pos - expected) <= tolerance))
+        if len(candidates):
+            best = candidates[np.argmin(np.abs(pause_pos[candidates] - expected))]
+            used[best] = True
+            anchor_from.append(bounds[k])
+            anchor_to.append(pause_pos[best])
+    anchor_from.append(total_voiced)
+    anchor_to.append(total_voiced)
+    bounds = np.interp(bounds, anchor_from, anchor_to)
+
+    # Trục thời gian có tiếng -> thời gian thật (nhảy qua các khoảng lặng)
+    starts = np.searchsorted(cum_voiced, bounds[:-1], side="right") * frame_s
+    ends = (np.searchsorted(cum_voiced, bounds[1:], side="left") + 1) * frame_s
+    ends = np.maximum(ends, starts + frame_s)
+
+    for word, start, end in zip(tokens, starts, ends):
+        track.add_word(round(float(start), 3), round(float(end), 3), f" {word}", "word")
+    index = 0
+    for part in parts:
+        count = len(part.split())
+        if count:
+            track.add_line(track.words[index].start, track.words[index + count - 1].end, part)
+            index += count
+
+    # Độ tin cậy: tỉ lệ dấu câu khớp được khoảng lặng, trừ các khoảng lặng dài không giải thích được,
+    # và tốc độ đọc phải hợp lý
+    matched_ratio = used.sum() / len(punct_bounds) if punct_bounds else 1.0
+    significant = pause_len >= ALIGN_SIGNIFICANT_PAUSE
+    unexplained = (significant & ~used).sum() / max(1, significant.sum())
+    rate = weights.sum() / (total_voiced * frame_s)
+    confidence = matched_ratio * (1 - 0.5 * unexplained)
+    if not 1.5 <= rate <= 10:
+        confidence *= 0.5
+    return track, float(confidence)
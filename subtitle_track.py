@@ -0,0 +1,143 @@
+import bisect
+import json
+import re
+
+
+class SubtitleLine:
+    __slots__ = ("start", "end", "text")
+
+    def __init__(self, start, end, text):
+        self.start = start
+        self.end = end
+        self.text = text
+
+
+class SubtitleWord:
+    """1 phần tử karaoke. kind = "word" nếu là từ thật của whisper, None nếu là cụm chia theo số từ."""
+
+    __slots__ = ("start", "end", "text", "kind")
+
+    def __init__(self, start, end, text, kind=None):
+        self.start = start
+        self.end = end
+        self.text = text
+        self.kind = kind
+
+    def to_dict(self):
+        record = {"start": self.start, "end": self.end, "text": self.text}
+        if self.kind:
+            record["type"] = self.kind
+        return record
+
+
+class WordIndex:
+    """
+    Chỉ mục thời gian của danh sách từ (đã sắp theo start) để tìm từ thuộc 1 dòng bằng bisect, O(log n).
+    ends là max cộng dồn của end nên luôn tăng dần, kể cả khi whisper trả về từ chồng lấn nhau.
+    """
+
+    def __init__(self, words):
+        self.words = words
+        self.starts = [w.start for w in words]
+        self.ends = []
+        max_end = float("-inf")
+        for w in words:
+            max_end = max(max_end, w.end)
+            self.ends.append(max_end)
+
+    def span(self, start, end):
+        """(lo, hi): words[lo:hi] là các từ có start < end, bắt đầu từ từ đầu tiên kết thúc sau start."""
+        lo = bisect.bisect_right(self.ends, start)
+        hi = bisect.bisect_left(self.starts, end, lo)
+        return lo, hi
+
+    def between(self, start, end):
+        lo, hi = self.span(start, end)
+        return [w for w in self.words[lo:hi] if w.end > start]
+
+
+class SubtitleTrack:
+    """
+    Phụ đề giữ trong RAM: transcribe_audio trả về trực tiếp, generate_karaoke_ass dùng luôn.
+    File .srt / .json chỉ là bản export tùy chọn.
+    """
+
+    __slots__ = ("lines", "words")
+
+    def __init__(self, lines=None, words=None):
+        self.lines = lines if lines is not None else []
+        self.words = words if words is not None else []
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def add_line(self, start, end, text):
+        self.lines.append(SubtitleLine(start, end, text))
+
+    def add_word(self, start, end, text, kind=None):
+        self.words.append(SubtitleWord(start, end, text, kind))
+
+    def add_segment(self, split_parts, records):
+        """Thêm 1 segment whisper đã tách: split_parts (start, end, text, word_data) + records karaoke."""
+        for start, end, text, _ in split_parts:
+            self.add_line(start, end, text)
+        for record in records:
+            self.add_word(record["start"], record["end"], record["text"], record.get("type"))
+
+    def karaoke_words(self):
+        return [w for w in self.words if w.kind == "word"]
+
+    def karaoke_index(self):
+        return WordIndex(self.karaoke_words())
+
+    # === Dạng gọn cho transcript cache ===
+
+    def to_compact(self):
+        """dict chỉ gồm list số / chuỗi (không lặp tên field cho từng từ), dùng để lưu cache."""
+        return {
+            "lines": [[line.start, line.end, line.text] for line in self.lines],
+            "words": [[w.start, w.end, w.text, w.kind] for w in self.words]
+        }
+
+    @classmethod
+    def from_compact(cls, data):
+        return cls([SubtitleLine(*line) for line in data["lines"]], [SubtitleWord(*w) for w in data["words"]])
+
+    # === Export / import file ===
+
+    def write_srt(self, srt_path, format_time):
+        with open(srt_path, "w", encoding="utf-8") as srt_file:
+            for idx, line in enumerate(self.lines, 1):
+                srt_file.write(f"{idx}\n")
+                srt_file.write(f"{format_time(line.start)} --> {format_time(line.end)}\n")
+                srt_file.write(f"{line.text}\n\n")
+
+    def write_json(self, json_path):
+        with open(json_path, "w", encoding="utf-8") as json_file:
+            json.dump([w.to_dict() for w in self.words], json_file, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def from_files(cls, srt_path, karaoke_json_path):
+        track = cls()
+        with open(karaoke_json_path, "r", encoding="utf-8") as f:
+            for w in json.load(f):
+                track.add_word(w["start"], w["end"], w["text"], w.get("type"))
+
+        with open(srt_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        blocks = re.split(r'\n\s*\n', content.strip())
+        for block in blocks:
+            lines = block.strip().split('\n')
+            if len(lines) >= 3:
+                time_line = lines[1]
+                text = ' '.join(lines[2:])
+                match = re.match(r'(\d{2}:\d{2}:\d{2},\d{3})\s*-->\s*(\d{2}:\d{2}:\d{2},\d{3})', time_line)
+                if match:
+                    track.add_line(convert_srt_time(match.group(1)), convert_srt_time(match.group(2)), text)
+        return track
+
+
+def convert_srt_time(srt_time):
+    h, m, s = srt_time.split(":")
+    s, ms = s.split(",")
+    return int(h) * 3600 + int(m) * 60 + int(s) + int(ms) / 1000
@@ -0,0 +1,178 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import numpy as np
+from faster_whisper import decode_audio
+
+import voice_google
+from subtitle_track import SubtitleTrack
+from voice_audio import VoiceAudio, WHISPER_SAMPLE_RATE, split_at_silence
+
+try:
+    from faster_whisper import BatchedInferencePipeline
+except ImportError:  # faster-whisper < 1.1 chưa có batched inference
+    BatchedInferencePipeline = None
+
+
+# Transcribe nhiều job trong 1 lần gọi batched: audio các job được nối lại (cách nhau bằng khoảng lặng),
+# mỗi job chia thành các chunk <= 30s, whisper decode BATCH_SIZE chunk cùng lúc
+TRANSCRIBE_BATCH_SIZE = 16
+TRANSCRIBE_BATCH_MAX_JOBS = 8  # Số job tối đa gom vào 1 batch
+TRANSCRIBE_BATCH_MAX_WAIT = 2.0  # Giây chờ thêm job trước khi chạy batch chưa đầy
+TRANSCRIBE_BATCH_CHUNK_SECONDS = 30.0
+TRANSCRIBE_BATCH_GAP_SECONDS = 1.0
+
+
+def _to_whisper_array(audio):
+    if isinstance(audio, VoiceAudio):
+        return audio.to_whisper_array()
+    return decode_audio(audio, sampling_rate=WHISPER_SAMPLE_RATE)
+
+
+def _shift_segment(segment, offset):
+    """Bản sao segment với mốc thời gian trừ đi offset (đưa về timeline riêng của job)."""
+    words = None
+    if getattr(segment, "words", None):
+        words = [
+            SimpleNamespace(start=w.start - offset, end=w.end - offset, word=w.word,
+                            probability=getattr(w, "probability", None))
+            for w in segment.words
+        ]
+    return SimpleNamespace(start=segment.start - offset, end=segment.end - offset, text=segment.text, words=words,
+                           temperature=getattr(segment, "temperature", 0.0))
+
+
+def _transcribe_group(jobs, language_code, model_settings, batch_size):
+    """1 lần gọi BatchedInferencePipeline cho các job cùng ngôn ngữ, trả về SubtitleTrack theo thứ tự jobs."""
+    gap = np.zeros(int(TRANSCRIBE_BATCH_GAP_SECONDS * WHISPER_SAMPLE_RATE), dtype=np.float32)
+    pieces = []
+    clips = []
+    job_starts = []  # Mốc bắt đầu (giây) của từng job trên timeline ghép
+    position = 0
+    for samples in jobs:
+        job_starts.append(position / WHISPER_SAMPLE_RATE)
+        for start, end in split_at_silence(samples, max_seconds=TRANSCRIBE_BATCH_CHUNK_SECONDS):
+            # clip_timestamps của BatchedInferencePipeline tính theo chỉ số sample, không phải giây
+            clips.append({"start": int(position + start), "end": int(position + end)})
+        pieces.extend((samples, gap))
+        position += len(samples) + len(gap)
+
+    tracks = [SubtitleTrack() for _ in jobs]
+    if not clips:
+        return tracks
+
+    model = voice_google.get_whisper_model(**model_settings)
+    pipeline = BatchedInferencePipeline(model=model)
+    segments, _ = pipeline.transcribe(np.concatenate(pieces), language=language_code, word_timestamps=True,
+                                      batch_size=batch_size, vad_filter=False, clip_timestamps=clips)
+    for segment in segments:
+        job_index = max(0, bisect.bisect_right(job_starts, segment.start) - 1)
+        shifted = _shift_segment(segment, job_starts[job_index])
+        split_parts = voice_google.split_text_and_timestamps(shifted, max_words=5)
+        tracks[job_index].add_segment(split_parts, voice_google.segment_word_records(shifted, split_parts))
+    return tracks
+
+
+def transcribe_batch(jobs, model_name="small", device="cpu", compute_type="default", cpu_threads=0, num_workers=1,
+                     batch_size=TRANSCRIBE_BATCH_SIZE, use_cache=True):
+    """
+    jobs: list (audio, language_code) với audio là VoiceAudio hoặc đường dẫn file.
+    Trả về list SubtitleTrack cùng thứ tự; các job cùng ngôn ngữ được decode chung 1 lần batched.
+    Job đã có trong transcript cache thì không đưa vào batch.
+    """
+    model_settings = {"model_name": model_name, "device": device, "compute_type": compute_type,
+                      "cpu_threads": cpu_threads, "num_workers": num_workers}
+    if BatchedInferencePipeline is None:
+        print("⚠️ faster-whisper chưa hỗ trợ batched inference, transcribe lần lượt từng job")
+        return [
+            voice_google.transcribe_audio(audio, None, language_code=language_code, export_files=False,
+                                          use_cache=use_cache, **model_settings)["subtitles"]
+            for audio, language_code in jobs
+        ]
+
+    results = [None] * len(jobs)
+    cache_keys = [None] * len(jobs)
+    groups = defaultdict(list)
+    for index, (audio, language_code) in enumerate(jobs):
+        if use_cache:
+            cache_keys[index] = voice_google.transcript_cache_key(audio, model_name, language_code,
+                                                                  compute_type=compute_type, mode="batched")
+            results[index] = voice_google.transcript_cache_get(cache_keys[index])
+            if results[index] is not None:
+                continue
+        groups[language_code].append(index)
+
+    for language_code, indexes in groups.items():
+        arrays = [_to_whisper_array(jobs[i][0]) for i in indexes]
+        total = sum(len(a) for a in arrays) / WHISPER_SAMPLE_RATE
+        print(f"🧠 Batched transcribe {len(indexes)} job ({total:.1f}s audio, ngôn ngữ: {language_code or 'auto'})")
+        for i, track in zip(indexes, _transcribe_group(arrays, language_code, model_settings, batch_size)):
+            results[i] = track
+            if cache_keys[i] and track:
+                voice_google.transcript_cache_put(cache_keys[i], track)
+    return results
+
+
+class BatchTranscriber:
+    """
+    Gom audio của các job đang chạy song song thành batch rồi transcribe 1 lần.
+    submit() trả về Future -> SubtitleTrack; batch chạy khi đủ max_jobs hoặc chờ quá max_wait giây.
+    """
+
+    def __init__(self, max_jobs=TRANSCRIBE_BATCH_MAX_JOBS, max_wait=TRANSCRIBE_BATCH_MAX_WAIT, **model_settings):
+        self.max_jobs = max_jobs
+        self.max_wait = max_wait
+        self.model_settings = model_settings
+        self._queue = []  # (audio, language_code, future, thời điểm submit)
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, audio, language_code=None):
+        future = Future()
+        with self._cond:
+            self._queue.append((audio, language_code, future, time.time()))
+            self._cond.notify()
+        return future
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._queue:
+                    waited = time.time() - self._queue[0][3]
+                    if len(self._queue) >= self.max_jobs or waited >= self.max_wait:
+                        batch, self._queue = self._queue[:self.max_jobs], self._queue[self.max_jobs:]
+                        return batch
+                    self._cond.wait(self.max_wait - waited)
+                else:
+                    self._cond.wait()
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                tracks = transcribe_batch([(audio, language_code) for audio, language_code, _, _ in batch],
+                                          **self.model_settings)
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future, _), track in zip(batch, tracks):
+                future.set_result(track)
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batch_transcriber(max_jobs=TRANSCRIBE_BATCH_MAX_JOBS, **model_settings):
+    """BatchTranscriber dùng chung, tạo lại khi đổi cấu hình model."""
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None or _batcher.max_jobs != max_jobs or _batcher.model_settings != model_settings:
+            _batcher = BatchTranscriber(max_jobs=max_jobs, **model_settings)
+        return _batcher
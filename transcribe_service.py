@@ -0,0 +1,269 @@
+import atexit
+import itertools
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+from voice_audio import VoiceAudio
+
+
+# Dịch vụ transcribe chạy ở các process riêng: không tranh GIL với Qt / pydub trong process GUI
+TRANSCRIBE_MAX_RETRIES = 2  # Số lần giao lại 1 job khi worker chết giữa chừng
+TRANSCRIBE_MAX_RESTARTS = 5  # Worker chết liên tiếp quá số lần này (vd. không load được model) thì bỏ hẳn
+TRANSCRIBE_POLL_SECONDS = 0.5
+
+
+def _load_audio(audio):
+    """Audio gửi qua queue: đường dẫn file hoặc ("shm", name, size, sample_rate, sample_width, channels)."""
+    if isinstance(audio, tuple) and audio[0] == "shm":
+        _, name, size, sample_rate, sample_width, channels = audio
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            pcm = bytes(shm.buf[:size])
+        finally:
+            shm.close()
+        return VoiceAudio(pcm, sample_rate=sample_rate, sample_width=sample_width, channels=channels)
+    return audio
+
+
+def _transcription_worker(index, tasks, results, model_settings):
+    """Process worker: load model 1 lần rồi transcribe lần lượt các job nhận từ queue."""
+    import voice_google
+
+    voice_google.get_whisper_model(**model_settings)
+    results.put(("ready", index, None, None))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, kind, audio, language_code, decode_options = task
+
+        def on_segment(item):
+            results.put(("progress", index, task_id, item["progress"]))
+
+        try:
+            if kind == "detect":
+                language = voice_google.detect_language(_load_audio(audio), **model_settings)
+                results.put(("done", index, task_id, language))
+                continue
+            result = voice_google.transcribe_audio(_load_audio(audio), None, language_code=language_code,
+                                                   on_segment=on_segment, export_files=False,
+                                                   decode_options=decode_options, **model_settings)
+            results.put(("done", index, task_id, {key: result[key] for key in
+                                                   ("subtitles", "language", "seconds", "fallbacks")}))
+        except Exception as e:
+            results.put(("error", index, task_id, f"{type(e).__name__}: {e}"))
+
+
+class TranscriptionTask:
+    __slots__ = ("task_id", "kind", "audio", "language_code", "decode_options", "future", "on_progress", "shm",
+                 "attempts")
+
+    def __init__(self, task_id, audio, language_code, on_progress=None, shm=None, decode_options=None,
+                 kind="transcribe"):
+        self.task_id = task_id
+        self.kind = kind
+        self.audio = audio
+        self.language_code = language_code
+        self.decode_options = decode_options
+        self.future = Future()
+        self.on_progress = on_progress
+        self.shm = shm
+        self.attempts = 0
+
+    def release(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class TranscriptionService:
+    """
+    ✅ N process worker, mỗi process load model whisper đúng 1 lần lúc khởi động
+    ✅ Audio gửi bằng đường dẫn hoặc PCM qua shared memory (không pickle cả mảng bytes)
+    ✅ Worker chết -> khởi động lại và giao lại job, không làm hỏng cả batch
+    """
+
+    def __init__(self, num_workers=2, model_name="small", device="cpu", compute_type="default", cpu_threads=0,
+                 max_retries=TRANSCRIBE_MAX_RETRIES):
+        self.model_settings = {
+            "model_name": model_name,
+            "device": device,
+            "compute_type": compute_type,
+            "cpu_threads": cpu_threads,
+            "num_workers": 1  # Mỗi process chỉ chạy 1 job một lúc
+        }
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self._ctx = multiprocessing.get_context("spawn")
+        self._results = self._ctx.Queue()
+        self._workers = [None] * num_workers  # (process, task_queue)
+        self._assigned = {}  # index worker -> task đang chạy
+        self._pending = deque()
+        self._crashes = [0] * num_workers  # Số lần chết liên tiếp của từng worker
+        self._given_up = set()
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+        for index in range(num_workers):
+            self._start_worker(index)
+        self._monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+        self._monitor.start()
+
+    def _start_worker(self, index):
+        tasks = self._ctx.Queue()
+        process = self._ctx.Process(target=_transcription_worker,
+                                    args=(index, tasks, self._results, self.model_settings), daemon=True)
+        process.start()
+        self._workers[index] = (process, tasks)
+
+    def transcribe(self, audio, language_code=None, on_progress=None, decode_options=None):
+        """
+        Gửi 1 job, trả về Future -> {"subtitles": SubtitleTrack, "language", "seconds", "fallbacks"}
+        (giống kết quả transcribe_audio, không có đường dẫn file).
+        audio: đường dẫn file hoặc VoiceAudio (PCM được chép vào shared memory).
+        on_progress(fraction) chạy trên thread monitor mỗi khi worker decode xong 1 segment.
+        decode_options: initial_prompt / hotwords... truyền thẳng cho transcribe_audio.
+        """
+        return self._submit("transcribe", audio, language_code, on_progress, decode_options)
+
+    def detect_language(self, audio):
+        """Nhận diện ngôn ngữ ở worker (process GUI không phải load model), trả về Future -> mã ngôn ngữ."""
+        return self._submit("detect", audio, None, None, None)
+
+    def _submit(self, kind, audio, language_code, on_progress, decode_options):
+        shm = None
+        payload = audio
+        if isinstance(audio, VoiceAudio):
+            size = len(audio.pcm)
+            shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+            shm.buf[:size] = audio.pcm
+            payload = ("shm", shm.name, size, audio.sample_rate, audio.sample_width, audio.channels)
+
+        task = TranscriptionTask(next(self._ids), payload, language_code, on_progress, shm, decode_options, kind)
+        with self._lock:
+            if self._closed:
+                task.release()
+                raise RuntimeError("TranscriptionService đã đóng")
+            self._pending.append(task)
+            self._dispatch()
+        return task.future
+
+    def _dispatch(self):
+        for index, (process, tasks) in enumerate(self._workers):
+            if not self._pending:
+                break
+            if index in self._assigned or not process.is_alive():
+                continue
+            task = self._pending.popleft()
+            task.attempts += 1
+            self._assigned[index] = task
+            tasks.put((task.task_id, task.kind, task.audio, task.language_code, task.decode_options))
+
+    def _finish(self, task, result=None, error=None):
+        task.release()
+        if error is not None:
+            task.future.set_exception(error)
+        else:
+            task.future.set_result(result)
+
+    def _handle_message(self, message):
+        kind, index, task_id, payload = message
+        if kind == "ready":
+            self._crashes[index] = 0
+            return
+        task = self._assigned.get(index)
+        if task is None or task.task_id != task_id:
+            return  # Tin nhắn của job đã bị giao lại cho worker khác
+        if kind == "progress":
+            if task.on_progress:
+                try:
+                    task.on_progress(payload)
+                except Exception as e:
+                    print(f"⚠️ Lỗi callback tiến độ transcribe: {e}")
+            return
+        self._crashes[index] = 0
+        del self._assigned[index]
+        if kind == "done":
+            self._finish(task, result=payload)
+        else:
+            self._finish(task, error=Exception(f"❌ Transcribe lỗi: {payload}"))
+
+    def _check_workers(self):
+        for index, (process, _) in enumerate(self._workers):
+            if index in self._given_up or process.is_alive():
+                continue
+            task = self._assigned.pop(index, None)
+            if task is not None:
+                if task.attempts > self.max_retries:
+                    self._finish(task, error=Exception(f"🛑 Worker transcribe chết {task.attempts} lần với job này"))
+                else:
+                    self._pending.appendleft(task)
+
+            self._crashes[index] += 1
+            if self._crashes[index] > TRANSCRIBE_MAX_RESTARTS:
+                print(f"🛑 Worker transcribe #{index} chết {self._crashes[index]} lần liên tiếp, dừng khởi động lại")
+                self._given_up.add(index)
+                continue
+            print(f"⚠️ Worker transcribe #{index} đã dừng (exit code {process.exitcode}), khởi động lại")
+            self._start_worker(index)
+
+        if len(self._given_up) == len(self._workers):
+            while self._pending:
+                self._finish(self._pending.popleft(), error=Exception("🛑 Không còn worker transcribe nào chạy được"))
+
+    def _monitor_loop(self):
+        while True:
+            try:
+                message = self._results.get(timeout=TRANSCRIBE_POLL_SECONDS)
+            except queue.Empty:
+                message = None
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                if self._closed:
+                    return
+                if message:
+                    self._handle_message(message)
+                self._check_workers()
+                self._dispatch()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for task in list(self._pending) + list(self._assigned.values()):
+                self._finish(task, error=Exception("TranscriptionService đã đóng"))
+            self._pending.clear()
+            self._assigned.clear()
+        for process, tasks in self._workers:
+            if process.is_alive():
+                tasks.put(None)
+        for process, _ in self._workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_transcription_service(num_workers=2, model_name="small", device="cpu", compute_type="default", cpu_threads=0):
+    """Service dùng chung cho cả batch, tạo lại nếu đổi số worker hoặc cấu hình model."""
+    global _service
+    with _service_lock:
+        wanted = dict(model_name=model_name, device=device, compute_type=compute_type, cpu_threads=cpu_threads)
+        if _service is not None and (_service.num_workers != num_workers or
+                                     any(_service.model_settings[k] != v for k, v in wanted.items())):
+            _service.close()
+            _service = None
+        if _service is None:
+            _service = TranscriptionService(num_workers=num_workers, **wanted)
+            atexit.register(_service.close)
+        return _service
@@ -0,0 +1,206 @@
+import os
+import atexit
+import asyncio
+import threading
+import time
+import aiohttp
+import voice_google
+from voice_google import (
+    InlineAudioDecoder, TTSApiError, VoiceAudio, build_tts_payload, format_proxy, parse_retry_after,
+    key_scheduler, proxy_pool, tts_latency, tts_cache_key, tts_cache_get, tts_cache_put,
+    tts_cache_get_bytes, tts_cache_put_bytes, save_pcm_as_mp3, _count_tts_attempt,
+    TTS_SAMPLE_RATE, TTS_SAMPLE_WIDTH, TTS_OUTPUT_FORMAT, TTS_STREAM_BLOCK_SIZE
+)
+
+
+# Client TTS asyncio dùng chung: 1 event loop, 1 connection pool, 1 semaphore cho cả process
+TTS_MAX_CONCURRENCY = 50  # Số request TTS tối đa đang chạy cùng lúc trong toàn process
+TTS_REQUEST_TIMEOUT = 60
+
+
+class AsyncTTSClient:
+    """
+    ✅ Event loop chạy ở 1 thread nền, mọi job gửi coroutine vào đây thay vì tự tạo thread
+    ✅ Semaphore toàn cục giới hạn số request đang bay
+    ✅ Dùng chung proxy_pool / key_scheduler / tts_latency với client đồng bộ
+    """
+
+    def __init__(self, max_concurrency=TTS_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        self._session = None
+        self._semaphore = None
+
+    def run(self, coro):
+        """Chạy coroutine trên loop dùng chung, chặn thread gọi cho tới khi xong."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        if self._session is not None:
+            self.run(self._session.close())
+            self._session = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _ensure_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def request_pcm(self, text, voice_name, api_key, proxy_str):
+        """1 lần gọi TTS, cập nhật điểm proxy và quota key giống tts_attempt."""
+        session = await self._ensure_session()
+        url = f"{voice_google.TTS_API_BASE}/{voice_google.TTS_MODEL_ID}:generateContent"
+        proxy = format_proxy(proxy_str)["http"] if proxy_str else None
+        _count_tts_attempt("attempts")
+
+        async with self._semaphore:
+            started = time.time()
+            try:
+                async with session.post(
+                    url,
+                    headers={"x-goog-api-key": api_key, "Content-Type": "application/json"},
+                    json=build_tts_payload(text, voice_name),
+                    proxy=proxy,
+                    timeout=aiohttp.ClientTimeout(total=TTS_REQUEST_TIMEOUT)
+                ) as response:
+                    if response.status != 200:
+                        body = await response.text() if response.status == 429 else ""
+                        retry_after = parse_retry_after(response.headers, body) if response.status == 429 else None
+                        raise TTSApiError(response.status, retry_after)
+
+                    pcm = bytearray()
+                    decoder = InlineAudioDecoder(pcm)
+                    async for block in response.content.iter_chunked(TTS_STREAM_BLOCK_SIZE):
+                        if decoder.feed(block):
+                            break
+                    else:
+                        raise Exception("Không tìm thấy inlineData.data trong response")
+            except TTSApiError as e:
+                # Lỗi từ API, không phải lỗi proxy -> không cập nhật điểm proxy
+                key_scheduler.report(api_key, e.status_code, e.retry_after)
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                proxy_pool.report(proxy_str, False, time.time() - started)
+                raise
+
+        proxy_pool.report(proxy_str, True, time.time() - started)
+        key_scheduler.report(api_key, 200)
+        return pcm
+
+    async def synthesize_pcm(self, text, api_key_list, voice_name="achird",
+                             max_inflight=None, max_attempts=None):
+        """Hedged request giống _synthesize_pcm_hedged nhưng hủy request thua ngay lập tức."""
+        max_inflight = max_inflight or voice_google.TTS_HEDGE_MAX_INFLIGHT
+        max_attempts = max_attempts or voice_google.TTS_HEDGE_MAX_ATTEMPTS
+        proxy_list = await asyncio.to_thread(proxy_pool.ordered)
+        hedge_delay = tts_latency.hedge_delay(len(text))
+        inflight = {}
+        attempts = 0
+        last_error = None
+        started = time.time()
+
+        async def launch(key_wait=0):
+            nonlocal attempts
+            deadline = time.time() + key_wait
+            api_key = key_scheduler.acquire(api_key_list)
+            while api_key is None and time.time() < deadline:
+                await asyncio.sleep(0.5)
+                api_key = key_scheduler.acquire(api_key_list)
+            if api_key is None:
+                return False
+            proxy_str = proxy_list[attempts % len(proxy_list)]
+            attempts += 1
+            print(f"[{attempts}] 🧪 Thử key: {api_key[:10]}... với proxy: {proxy_str}")
+            task = asyncio.ensure_future(self.request_pcm(text, voice_name, api_key, proxy_str))
+            inflight[task] = api_key
+            return True
+
+        _count_tts_attempt("requests")
+        try:
+            await launch(voice_google.TTS_KEY_WAIT_SECONDS)
+            while inflight:
+                done, _ = await asyncio.wait(list(inflight), timeout=hedge_delay,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if len(inflight) < max_inflight and attempts < max_attempts and await launch():
+                        _count_tts_attempt("hedged")
+                        print(f"⏱️ Quá {hedge_delay:.1f}s chưa có kết quả, gửi thêm request dự phòng")
+                    continue
+
+                for task in done:
+                    api_key = inflight.pop(task)
+                    try:
+                        pcm = task.result()
+                    except Exception as e:
+                        last_error = e
+                        print(f"❌ Key {api_key[:10]} lỗi: {e}")
+                        continue
+                    tts_latency.add(time.time() - started, len(text))
+                    return pcm
+
+                if not inflight and attempts < max_attempts:
+                    await launch(voice_google.TTS_KEY_WAIT_SECONDS)
+        finally:
+            if inflight:
+                _count_tts_attempt("cancelled", len(inflight))
+            for task in inflight:
+                task.cancel()
+
+        raise Exception(f"🛑 Không có key nào khả dụng để tạo voice. ({last_error})")
+
+    async def create_voice_audio(self, text, api_key_list, voice_name="achird", use_cache=True):
+        cache_key = tts_cache_key(text, voice_name, output_format="pcm") if use_cache else None
+        pcm = await asyncio.to_thread(tts_cache_get_bytes, cache_key, "pcm") if cache_key else None
+        if pcm is not None:
+            print("♻️ Dùng lại voice PCM từ cache")
+        else:
+            pcm = await self.synthesize_pcm(text, api_key_list, voice_name=voice_name)
+            if cache_key:
+                await asyncio.to_thread(tts_cache_put_bytes, cache_key, pcm, "pcm")
+        return VoiceAudio(pcm, sample_rate=TTS_SAMPLE_RATE, sample_width=TTS_SAMPLE_WIDTH)
+
+    async def create_voice(self, text, output_file_pcm, api_key_list, voice_name="achird", use_cache=True):
+        cache_key = tts_cache_key(text, voice_name) if use_cache else None
+        if cache_key:
+            base_name, _ = os.path.splitext(output_file_pcm)
+            timestamp = time.strftime("%Y%m%d%H%M%S")
+            cached_file = f"{base_name}_{timestamp}.{TTS_OUTPUT_FORMAT}"
+            if await asyncio.to_thread(tts_cache_get, cache_key, cached_file):
+                print(f"♻️ Dùng lại voice từ cache: {cached_file}")
+                return cached_file
+
+        pcm = await self.synthesize_pcm(text, api_key_list, voice_name=voice_name)
+        mp3_file = await asyncio.to_thread(save_pcm_as_mp3, pcm, output_file_pcm)
+        if cache_key:
+            await asyncio.to_thread(tts_cache_put, cache_key, mp3_file)
+        return mp3_file
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_tts_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = AsyncTTSClient()
+            atexit.register(_client.close)
+        return _client
+
+
+# Wrapper đồng bộ, cùng chữ ký với bản trong voice_google (max_workers giữ lại cho tương thích)
+
+def create_voice_with_retry(text, output_file_pcm, api_key_list, voice_name="achird", max_workers=5, use_cache=True):
+    client = get_tts_client()
+    return client.run(client.create_voice(text, output_file_pcm, api_key_list, voice_name=voice_name,
+                                          use_cache=use_cache))
+
+
+def create_voice_audio(text, api_key_list, voice_name="achird", max_workers=5, use_cache=True):
+    client = get_tts_client()
+    return client.run(client.create_voice_audio(text, api_key_list, voice_name=voice_name, use_cache=use_cache))
@@ -1,12 +1,36 @@
 import os
+import json
+import math
 import random
 import hashlib
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from moviepy.editor import VideoFileClip, AudioFileClip
 from pydub import AudioSegment
 import ffmpeg
 import subprocess
 from pathlib import Path
+from voice_audio import VoiceAudio
+from disk_cache import evict_cache_dir, KeyLocks
+
+
+# Cache segment đã chuẩn hóa (scale/pad, 30fps, libx264): cùng thư mục media dùng lại giữa các job và các batch
+SEGMENT_CACHE_ENABLED = True
+SEGMENT_CACHE_DIR = os.path.join("cache", "segments")
+SEGMENT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+SEGMENT_DURATION_BUCKET = 0.5  # Độ dài segment làm tròn lên bội số này (giây) để job có voice dài khác nhau dùng chung
+_segment_cache_stats = {"hit": 0, "miss": 0}
+_segment_cache_lock = threading.Lock()  # Giữ khi đếm hit/miss, đánh dấu segment đang dùng và khi dọn cache
+_segments_in_use = {}  # Đường dẫn segment -> số job đang dùng (chưa ghép xong), không bị xóa khi dọn cache
+_segment_key_locks = KeyLocks()
+
+# Encode segment song song: mỗi job 1 pool thread, tổng số ffmpeg đang encode của mọi job bị giới hạn theo số core
+FFMPEG_CPU_BUDGET = os.cpu_count() or 4  # Tổng số core dành cho encode segment (dùng chung cho mọi job)
+SEGMENT_ENCODE_THREADS = 2  # -threads của mỗi ffmpeg encode segment
+SEGMENT_ENCODE_WORKERS = max(1, FFMPEG_CPU_BUDGET // SEGMENT_ENCODE_THREADS)  # Số segment encode cùng lúc trong 1 job
+_encode_slots = threading.BoundedSemaphore(max(1, FFMPEG_CPU_BUDGET // SEGMENT_ENCODE_THREADS))
 
 def has_audio_stream(video_path):
     result = subprocess.run([
@@ -39,6 +63,110 @@ def adjust_segment_timing(total_duration: float, target_segment_duration: float
     return s, optimal_dur, optimal_t
 
 
+def encode_segment(src, out_path, width, height, crop, duration, offset=0.0):
+    """
+    Scale (crop) hoặc scale + pad 1 ảnh / clip về width x height, 30fps, dài duration giây tính từ offset.
+    Trả về số giây encode thật (không tính thời gian chờ slot CPU).
+    """
+    ext = Path(src).suffix.lower()
+    if ext in [".jpg", ".png"]:
+        input_ff = ffmpeg.input(src, loop=1, t=duration)
+    elif offset:
+        input_ff = ffmpeg.input(src, ss=offset)
+    else:
+        input_ff = ffmpeg.input(src)
+
+    if crop:
+        input_ff = input_ff.filter('scale', width, height)
+    else:
+        input_ff = (
+            input_ff
+            .filter('scale',
+                    f"if(gt(a,{width}/{height}),{width},-1)",
+                    f"if(gt(a,{width}/{height}),-1,{height})")
+            .filter('pad', width, height, '(ow-iw)/2', '(oh-ih)/2')
+        )
+
+    with _encode_slots:
+        start = time.time()
+        (
+            input_ff
+            .output(str(out_path), t=duration, vcodec='libx264', pix_fmt='yuv420p', r=30, format='mp4',
+                    threads=SEGMENT_ENCODE_THREADS, loglevel='error')
+            .overwrite_output()
+            .run()
+        )
+        return time.time() - start
+
+
+def segment_cache_key(src, width, height, crop, duration, offset=0.0):
+    """Hash của (đường dẫn, mtime, size file nguồn, kích thước đích, crop, độ dài, offset)."""
+    st = os.stat(src)
+    raw = [os.path.abspath(src), st.st_mtime_ns, st.st_size, width, height, bool(crop),
+           round(duration, 3), round(offset, 3)]
+    return hashlib.sha256(json.dumps(raw, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def segment_key_lock(key):
+    """Các job cần cùng 1 segment chờ nhau: job đầu encode, job sau lấy file từ cache."""
+    return _segment_key_locks.hold(key)
+
+
+def cached_segment(src, width, height, crop, duration, offset=0.0):
+    """
+    Đường dẫn segment đã chuẩn hóa trong cache, chưa có thì encode (ghi file tạm rồi đổi tên).
+    Segment được encode dài bằng duration làm tròn lên SEGMENT_DURATION_BUCKET, bước ghép sẽ trim về đúng độ dài.
+    Trả về (đường dẫn, số giây encode); số giây encode là None nếu lấy từ cache.
+    Segment được đánh dấu đang dùng cho tới khi job gọi release_segments() sau bước ghép.
+    """
+    duration = math.ceil(round(duration / SEGMENT_DURATION_BUCKET, 6)) * SEGMENT_DURATION_BUCKET
+    key = segment_cache_key(src, width, height, crop, duration, offset)
+    cache_path = os.path.join(SEGMENT_CACHE_DIR, f"{key}.mp4")
+    with segment_key_lock(key):
+        # Kiểm tra cache và đánh dấu đang dùng trong cùng 1 lần giữ lock: job khác dọn cache không xóa mất ở giữa
+        with _segment_cache_lock:
+            try:
+                hit = os.path.getsize(cache_path) > 0
+                os.utime(cache_path)  # Đánh dấu vừa dùng (LRU)
+            except OSError:
+                hit = False
+            _segment_cache_stats["hit" if hit else "miss"] += 1
+            _segments_in_use[cache_path] = _segments_in_use.get(cache_path, 0) + 1
+        if hit:
+            return cache_path, None
+
+        os.makedirs(SEGMENT_CACHE_DIR, exist_ok=True)
+        temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            encode_seconds = encode_segment(src, temp_path, width, height, crop, duration, offset)
+            os.replace(temp_path, cache_path)
+        except Exception:
+            release_segments([cache_path], evict=False)
+            raise
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return cache_path, encode_seconds
+
+
+def release_segments(paths, evict=True):
+    """Bỏ đánh dấu đang dùng các segment của 1 job (gọi sau khi ghép xong), rồi dọn cache nếu quá giới hạn."""
+    with _segment_cache_lock:
+        for path in paths:
+            count = _segments_in_use.get(path, 0) - 1
+            if count > 0:
+                _segments_in_use[path] = count
+            else:
+                _segments_in_use.pop(path, None)
+        if evict and os.path.isdir(SEGMENT_CACHE_DIR):
+            evict_cache_dir(SEGMENT_CACHE_DIR, SEGMENT_CACHE_MAX_BYTES, keep=set(_segments_in_use))
+
+
+def get_segment_cache_stats():
+    with _segment_cache_lock:
+        return dict(_segment_cache_stats)
+
+
 def create_video_randomized_media(media_files, total_duration, change_every, word_count, output_file,
                                          is_vertical=True, crop=True, transition_effects=None):
     width, height = (1080, 1920) if is_vertical else (1920, 1080)
@@ -53,142 +181,157 @@ def create_video_randomized_media(media_files, total_duration, change_every, wor
     temp_dir = Path(f"temp_ffmpeg_{hash_id}").resolve()
     temp_dir.mkdir(exist_ok=True)
 
-    segment_paths = []
     print(f"📐 Video size: {width}x{height}, segments: {num_segments}, mỗi đoạn: {duration_per_segment:.2f}s")
 
-    for i in range(num_segments):
-        src = random.choice(media_files)
-        ext = Path(src).suffix.lower()
-        out_path = temp_dir / f"seg_{i:03}.mp4"
-
-        try:
-            input_ff = ffmpeg.input(src, loop=1, t=duration_per_segment) if ext in [".jpg", ".png"] else ffmpeg.input(src)
-
-            if crop:
-                input_ff = input_ff.filter('scale', width, height)
+    def make_segment(i, src):
+        start = time.time()
+        if SEGMENT_CACHE_ENABLED:
+            path, encode_seconds = cached_segment(src, width, height, crop, duration_per_segment)
+        else:
+            path = str(temp_dir / f"seg_{i:03}.mp4")
+            encode_seconds = encode_segment(src, path, width, height, crop, duration_per_segment)
+        # Thời gian chờ = chờ slot CPU (_encode_slots) + chờ job khác encode cùng segment (single-flight)
+        return path, encode_seconds, time.time() - start - (encode_seconds or 0.0)
+
+    # Chọn media theo đúng thứ tự random như trước, encode song song, lấy kết quả theo thứ tự segment
+    sources = [random.choice(media_files) for _ in range(num_segments)]
+    stage_start = time.time()
+    segment_paths = []
+    encoded = cached = 0
+    encode_total = 0.0
+    workers = max(1, min(SEGMENT_ENCODE_WORKERS, num_segments))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(make_segment, i, src) for i, src in enumerate(sources)]
+        for i, (src, future) in enumerate(zip(sources, futures)):
+            try:
+                path, encode_seconds, wait_seconds = future.result()
+            except Exception as e:
+                print(f"❌ Lỗi xử lý {src}: {e}")
+                continue
+            if encode_seconds is None:
+                cached += 1
+                print(f"♻️ Segment {i:03} ({Path(src).name}): lấy từ cache, chờ {wait_seconds:.2f}s")
             else:
-                input_ff = (
-                    input_ff
-                    .filter('scale',
-                            f"if(gt(a,{width}/{height}),{width},-1)",
-                            f"if(gt(a,{width}/{height}),-1,{height})")
-                    .filter('pad', width, height, '(ow-iw)/2', '(oh-ih)/2')
-                )
-
-            (
-                input_ff
-                .output(str(out_path), t=duration_per_segment, vcodec='libx264', pix_fmt='yuv420p', r=30, loglevel='error')
-                .overwrite_output()
-                .run()
-            )
-            segment_paths.append(str(out_path))
-        except Exception as e:
-            print(f"❌ Lỗi xử lý {src}: {e}")
-            continue
-
-    if not segment_paths:
-        raise Exception("❌ Không có segment nào được tạo!")
-
-    # 🔄 Ghép bằng ffmpeg filter_complex + xfade
-    print("🔄 Ghép segment kèm hiệu ứng chuyển cảnh...")
+                encoded += 1
+                encode_total += encode_seconds
+                print(f"⏱️ Segment {i:03} ({Path(src).name}): encode {encode_seconds:.2f}s, chờ {wait_seconds:.2f}s")
+            segment_paths.append(path)
+    print(f"🎞️ {len(segment_paths)}/{num_segments} segment xong trong {time.time() - stage_start:.2f}s "
+          f"({workers} luồng): {encoded} encode (tổng {encode_total:.2f}s), {cached} từ cache")
 
-    filter_complex = ""
-    inputs = ""
-    maps = []
-    last_v = ""
-    last_a = ""
-    offset = 0.0
-    dur = min(0.7, duration_per_segment / 2)
+    if SEGMENT_CACHE_ENABLED:
+        stats = get_segment_cache_stats()
+        print(f"🗃️ Segment cache: {stats['hit']} hit / {stats['miss']} miss")
 
-    has_audio = []
+    try:
+        if not segment_paths:
+            raise Exception("❌ Không có segment nào được tạo!")
+
+        # 🔄 Ghép bằng ffmpeg filter_complex + xfade
+        print("🔄 Ghép segment kèm hiệu ứng chuyển cảnh...")
+
+        filter_complex = ""
+        inputs = ""
+        maps = []
+        last_v = ""
+        last_a = ""
+        offset = 0.0
+        dur = min(0.7, duration_per_segment / 2)
+
+        has_audio = []
+
+        cmd = ["ffmpeg"]
+
+        # Chuẩn bị input và kiểm tra audio
+        for i, path in enumerate(segment_paths):
+            cmd += ["-i", path]
+            # trim: segment lấy từ cache có thể dài hơn duration_per_segment (độ dài đã làm tròn lên)
+            filter_complex += (f"[{i}:v]trim=duration={duration_per_segment:.3f},setpts=PTS-STARTPTS,"
+                               f"format=yuv420p,scale={width}:{height},fps=30[v{i}];")
+            
+            if has_audio_stream(path):
+                filter_complex += f"[{i}:a]aformat=sample_fmts=fltp:sample_rates=44100:channel_layouts=stereo[a{i}];"
+                has_audio.append(True)
+            else:
+                has_audio.append(False)
+
+        last_v = "v0"
+        last_a = "a0" if has_audio[0] else None
+        if transition_effects is None:
+                transition_effects = [
+                    "fade",         # Làm mờ dần
+                    "fadeblack",    # Mờ thành đen
+                    "fadewhite",    # Mờ thành trắng
+                    "slideleft",    # Trượt sang trái
+                    "slideright",   # Trượt sang phải
+                    "slideup",      # Trượt lên trên
+                    "slidedown"     # Trượt xuống dưới
+                ]
+
+
+        print(f"📽 Số hiệu ứng chuyển cảnh: {len(transition_effects)} | Hiệu ứng mẫu: {transition_effects}")
+
+        for i in range(1, len(segment_paths)):
+            effect = random.choice(transition_effects)
+            filter_complex += f"[{last_v}][v{i}]xfade=transition={effect}:duration={dur}:offset={offset:.2f}[v{i}_out];"
+            last_v = f"v{i}_out"
+
+            if has_audio[i] and last_a:
+                filter_complex += f"[{last_a}][a{i}]acrossfade=d={dur}[a{i}_out];"
+                last_a = f"a{i}_out"
+            else:
+                last_a = None
 
-    cmd = ["ffmpeg"]
+            offset += duration_per_segment - dur
 
-    # Chuẩn bị input và kiểm tra audio
-    for i, path in enumerate(segment_paths):
-        cmd += ["-i", path]
-        filter_complex += f"[{i}:v]format=yuv420p,scale={width}:{height},fps=30[v{i}];"
+        # Tạo và chạy lệnh ffmpeg
         
-        if has_audio_stream(path):
-            filter_complex += f"[{i}:a]aformat=sample_fmts=fltp:sample_rates=44100:channel_layouts=stereo[a{i}];"
-            has_audio.append(True)
-        else:
-            has_audio.append(False)
-
-    last_v = "v0"
-    last_a = "a0" if has_audio[0] else None
-    if transition_effects is None:
-            transition_effects = [
-                "fade",         # Làm mờ dần
-                "fadeblack",    # Mờ thành đen
-                "fadewhite",    # Mờ thành trắng
-                "slideleft",    # Trượt sang trái
-                "slideright",   # Trượt sang phải
-                "slideup",      # Trượt lên trên
-                "slidedown"     # Trượt xuống dưới
-            ]
-
-
-    print(f"📽 Số hiệu ứng chuyển cảnh: {len(transition_effects)} | Hiệu ứng mẫu: {transition_effects}")
-
-    for i in range(1, len(segment_paths)):
-        effect = random.choice(transition_effects)
-        filter_complex += f"[{last_v}][v{i}]xfade=transition={effect}:duration={dur}:offset={offset:.2f}[v{i}_out];"
-        last_v = f"v{i}_out"
-
-        if has_audio[i] and last_a:
-            filter_complex += f"[{last_a}][a{i}]acrossfade=d={dur}[a{i}_out];"
-            last_a = f"a{i}_out"
-        else:
-            last_a = None
-
-        offset += duration_per_segment - dur
+        cmd += sum([["-i", path] for path in segment_paths], [])
 
-    # Tạo và chạy lệnh ffmpeg
-    
-    cmd += sum([["-i", path] for path in segment_paths], [])
+        cmd += [
+        "-filter_complex", filter_complex,
+        "-map", f"[{last_v}]"
+        ]
 
-    cmd += [
-    "-filter_complex", filter_complex,
-    "-map", f"[{last_v}]"
-    ]
+        if last_a:
+            cmd += ["-map", f"[{last_a}]"]
 
-    if last_a:
-        cmd += ["-map", f"[{last_a}]"]
+        cmd += [
+            "-c:v", "libx264",
+            "-c:a", "aac",
+            "-pix_fmt", "yuv420p",
+            "-r", "30",
+            "-shortest",
+            "-y",
+            output_file
+        ]
 
-    cmd += [
-        "-c:v", "libx264",
-        "-c:a", "aac",
-        "-pix_fmt", "yuv420p",
-        "-r", "30",
-        "-shortest",
-        "-y",
-        output_file
-    ]
 
+        
+        try:
+            result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
 
-    
-    try:
-        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-
-        # In log chi tiết FFmpeg (dễ debug)
-        print("📥 FFmpeg output:")
-        print(result.stdout)
+            # In log chi tiết FFmpeg (dễ debug)
+            print("📥 FFmpeg output:")
+            print(result.stdout)
 
-        for i in range(10):
-            if os.path.exists(output_file) and os.path.getsize(output_file) > 1024:
-                break
-            print(f"⏳ Đợi FFmpeg hoàn tất ghi file... ({i+1}s)")
-            time.sleep(1)
+            for i in range(10):
+                if os.path.exists(output_file) and os.path.getsize(output_file) > 1024:
+                    break
+                print(f"⏳ Đợi FFmpeg hoàn tất ghi file... ({i+1}s)")
+                time.sleep(1)
 
-        if result.returncode != 0:
-            print(f"❌ Lỗi khi ghép video. Exit code: {result.returncode}")
-            raise Exception("FFmpeg failed. Xem log ở trên để biết chi tiết.")
+            if result.returncode != 0:
+                print(f"❌ Lỗi khi ghép video. Exit code: {result.returncode}")
+                raise Exception("FFmpeg failed. Xem log ở trên để biết chi tiết.")
 
-        print(f"✅ Đã tạo video hoàn tất: {output_file}")
+            print(f"✅ Đã tạo video hoàn tất: {output_file}")
 
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Lỗi khi ghép video: {e}")
+        except subprocess.CalledProcessError as e:
+            print(f"❌ Lỗi khi ghép video: {e}")
+    finally:
+        if SEGMENT_CACHE_ENABLED:
+            release_segments(segment_paths)  # Ghép xong (hoặc lỗi): segment của job này được phép bị dọn khỏi cache
 
     # Dọn temp
     for f in temp_dir.glob("*"):
@@ -203,13 +346,18 @@ def burn_sub_and_audio(video_path, srt_path, voice_path, output_path,
                        bg_music_path=None, bg_music_volume=30):
     print("🎬 Bắt đầu render với phụ đề và âm thanh...")
 
-    voice_duration = AudioFileClip(voice_path).duration
+    # voice_path có thể là VoiceAudio (PCM trong RAM) -> không decode lại, stream PCM thẳng vào ffmpeg
+    voice_audio = voice_path if isinstance(voice_path, VoiceAudio) else None
+    if voice_audio:
+        voice_duration = voice_audio.duration
+    else:
+        voice_duration = AudioFileClip(voice_path).duration
     temp_combined_audio = None
-
-    # Xử lý âm thanh
-    base_audio = AudioSegment.from_file(voice_path)
+    audio_pipe = None
 
     if bg_music_path and os.path.exists(bg_music_path):
+        # Xử lý âm thanh
+        base_audio = voice_audio.to_audio_segment() if voice_audio else AudioSegment.from_file(voice_path)
         bg_audio = AudioSegment.from_file(bg_music_path)
         times = int(len(base_audio) / len(bg_audio)) + 1
         bg_audio = (bg_audio * times)[:len(base_audio)]
@@ -217,20 +365,24 @@ def burn_sub_and_audio(video_path, srt_path, voice_path, output_path,
         bg_audio = bg_audio - volume_db
         combined = base_audio.overlay(bg_audio)
 
-        # Tạo file âm thanh tạm thời kết hợp giữa voice và nhạc nền
-        hash_id = hashlib.md5(output_path.encode()).hexdigest()[:8]
-        temp_combined_audio = f"combined_temp_audio_{hash_id}.mp3"
-        combined.export(temp_combined_audio, format="mp3")
+        if voice_audio:
+            audio_pipe = VoiceAudio.from_audio_segment(combined)
+        else:
+            # Tạo file âm thanh tạm thời kết hợp giữa voice và nhạc nền
+            hash_id = hashlib.md5(output_path.encode()).hexdigest()[:8]
+            temp_combined_audio = f"combined_temp_audio_{hash_id}.mp3"
+            combined.export(temp_combined_audio, format="mp3")
 
-        for _ in range(20):
-            if os.path.exists(temp_combined_audio):
-                break
-            time.sleep(0.1)
+            for _ in range(20):
+                if os.path.exists(temp_combined_audio):
+                    break
+                time.sleep(0.1)
 
-        audio_path = temp_combined_audio
+            audio_path = temp_combined_audio
         print(f"🔊 Nhạc nền đã thêm từ: {bg_music_path} - Âm lượng: {bg_music_volume}%")
     else:
         # Nếu không có nhạc nền, chỉ sử dụng voice
+        audio_pipe = voice_audio
         audio_path = voice_path
         print("🎵 Không sử dụng nhạc nền, chỉ dùng âm thanh voice.")
 
@@ -245,23 +397,24 @@ def burn_sub_and_audio(video_path, srt_path, voice_path, output_path,
         print(f"❌ Font '{font_name}' không tìm thấy trong thư mục fonts. Sử dụng font mặc định.")
         
 
-    # Filter subtitle
-    srt_safe = srt_path.replace("\\", "/")
-    font_name = font_name.replace("-", " ").replace("_", " ")
-    subtitle_filter = (
-        f"subtitles='{srt_safe}':fontsdir='{fonts_dir}':"
-        f"force_style='FontName={font_name},FontSize={font_size},PrimaryColour={ff_color},Alignment=2,MarginV=9'"
-    )
-    
     # Subtitle filter
     vf_filters = []
-    ass_path = srt_path.replace(".srt", ".ass").replace("\\", "/")
+    if srt_path:  # None = video không có phụ đề
+        srt_safe = srt_path.replace("\\", "/")
+        font_name = font_name.replace("-", " ").replace("_", " ")
+        subtitle_filter = (
+            f"subtitles='{srt_safe}':fontsdir='{fonts_dir}':"
+            f"force_style='FontName={font_name},FontSize={font_size},PrimaryColour={ff_color},Alignment=2,MarginV=9'"
+        )
+        ass_path = srt_path.replace(".srt", ".ass").replace("\\", "/")
+
+        if os.path.exists(ass_path):
+            ass_safe = ass_path.replace(":", "\\\\:").replace("'", "\\'")
+            vf_filters.append(f"ass={ass_safe}:fontsdir=fonts")
+        else:
+            vf_filters.append(subtitle_filter)
 
-    if os.path.exists(ass_path):
-        ass_safe = ass_path.replace(":", "\\\\:").replace("'", "\\'")
-        vf_filters.append(f"ass={ass_safe}:fontsdir=fonts")
-    else:
-        vf_filters.append(subtitle_filter)
+    output_options = {}
 
     # Thử lại tối đa 3 lần nếu lỗi
     max_retries = 3
@@ -269,20 +422,27 @@ def burn_sub_and_audio(video_path, srt_path, voice_path, output_path,
         try:
             print(f"🚀 Render attempt {attempt}...")
             input_video = ffmpeg.input(video_path, t=voice_duration)
-            input_audio = ffmpeg.input(audio_path)
+            if audio_pipe:
+                # PCM chỉ bị encode (aac) đúng 1 lần ở bước mux cuối
+                input_audio = ffmpeg.input("pipe:", f=audio_pipe.ffmpeg_format,
+                                           ar=audio_pipe.sample_rate, ac=audio_pipe.channels)
+            else:
+                input_audio = ffmpeg.input(audio_path)
 
+            if vf_filters:
+                output_options["vf"] = ",".join(vf_filters)
             ffmpeg.output(
                     input_video,
                     input_audio,
                     output_path,
-                    vf=",".join(vf_filters),
+                    **output_options,
                     vcodec="libx264",
                     acodec="aac",
                     preset="slow",
                     pix_fmt="yuv420p",
                     t=voice_duration,
                     video_bitrate="5000k"
-            ).overwrite_output().run()
+            ).overwrite_output().run(input=audio_pipe.pcm if audio_pipe else None)
        
 
             print(f"✅ Xuất video hoàn tất: {output_path}")
@@ -309,3 +469,129 @@ def percent_to_db(percent):
     """Chuyển % volume về decibel tương đối (dB giảm)."""
     percent = max(1, min(percent, 100))  # tránh chia 0
     return 40 * (1 - percent / 100)  # càng nhỏ càng giảm mạnh
+
+
+DEFAULT_TRANSITIONS = ["fade", "fadeblack", "fadewhite", "slideleft", "slideright", "slideup", "slidedown"]
+
+
+def _escape_filter_path(path):
+    """Đường dẫn dùng trong filter graph (ass=...): đổi \\ thành /, escape : và '."""
+    return path.replace("\\", "/").replace(":", "\\\\:").replace("'", "\\'")
+
+
+def render_video_fused(media_files, voice, output_path, ass_path=None, is_vertical=True, crop=True,
+                       bg_music_path=None, bg_music_volume=30, transition_effects=None, preset="slow"):
+    """
+    Render 1 lượt: scale/pad từng media + xfade + phụ đề ass + mix nhạc nền trong cùng 1 filter graph,
+    encode libx264 đúng 1 lần thẳng ra output_path (không có segment / temp_video trung gian).
+    voice: VoiceAudio (PCM đưa qua stdin) hoặc đường dẫn file audio.
+    """
+    width, height = (1080, 1920) if is_vertical else (1920, 1080)
+    voice_audio = voice if isinstance(voice, VoiceAudio) else None
+    voice_duration = voice_audio.duration if voice_audio else AudioFileClip(voice).duration
+
+    num_segments, _, _ = adjust_segment_timing(voice_duration, target_segment_duration=4.5,
+                                               max_transition_duration=1.2)
+    # Tính hiệu ứng chuyển trước, rồi kéo dài segment để bù phần chồng của xfade: tổng video = đúng độ dài voice
+    dur = min(0.7, voice_duration / num_segments / 2)
+    duration_per_segment = (voice_duration + (num_segments - 1) * dur) / num_segments
+    # Cùng thứ tự random như create_video_randomized_media: chọn media trước, hiệu ứng sau
+    sources = [random.choice(media_files) for _ in range(num_segments)]
+    effects = [random.choice(transition_effects or DEFAULT_TRANSITIONS) for _ in range(num_segments - 1)]
+    print(f"⚡ Render 1 lượt: {num_segments} segment x {duration_per_segment:.2f}s, chuyển cảnh {dur:.2f}s")
+
+    cmd = ["ffmpeg", "-y", "-loglevel", "error"]
+    filters = []
+    for i, src in enumerate(sources):
+        if Path(src).suffix.lower() in [".jpg", ".png"]:
+            cmd += ["-loop", "1", "-t", f"{duration_per_segment:.3f}", "-i", src]
+        else:
+            cmd += ["-i", src]
+        if crop:
+            scale = f"scale={width}:{height}"
+        else:
+            scale = (f"scale='if(gt(a,{width}/{height}),{width},-1)':'if(gt(a,{width}/{height}),-1,{height})',"
+                     f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2")
+        # tpad: clip ngắn hơn segment thì giữ khung cuối để offset xfade luôn đúng
+        # fps sau setpts: xfade cần frame rate cố định, setpts làm mất thông tin này
+        filters.append(
+            f"[{i}:v]{scale},setsar=1,fps=30,format=yuv420p,"
+            f"tpad=stop_mode=clone:stop_duration={duration_per_segment:.3f},"
+            f"trim=duration={duration_per_segment:.3f},setpts=PTS-STARTPTS,fps=30[v{i}]"
+        )
+
+    last_v = "v0"
+    offset = 0.0
+    for i in range(1, num_segments):
+        offset += duration_per_segment - dur
+        filters.append(f"[{last_v}][v{i}]xfade=transition={effects[i - 1]}:duration={dur}:offset={offset:.3f}[x{i}]")
+        last_v = f"x{i}"
+
+    if ass_path and os.path.exists(ass_path):
+        filters.append(f"[{last_v}]ass={_escape_filter_path(ass_path)}:fontsdir=fonts[vout]")
+        last_v = "vout"
+
+    voice_index = num_segments
+    if voice_audio:
+        cmd += ["-f", voice_audio.ffmpeg_format, "-ar", str(voice_audio.sample_rate),
+                "-ac", str(voice_audio.channels), "-i", "pipe:0"]
+    else:
+        cmd += ["-i", voice]
+    last_a = f"{voice_index}:a"
+    if bg_music_path and os.path.exists(bg_music_path):
+        cmd += ["-stream_loop", "-1", "-i", bg_music_path]
+        # Giống pydub overlay: nhạc nền giảm percent_to_db dB, độ dài theo voice, không chuẩn hóa âm lượng
+        filters.append(f"[{voice_index + 1}:a]volume=-{percent_to_db(bg_music_volume):.2f}dB[bg]")
+        filters.append(f"[{voice_index}:a][bg]amix=inputs=2:duration=first:dropout_transition=0:normalize=0[aout]")
+        last_a = "aout"
+
+    cmd += [
+        "-filter_complex", ";".join(filters),
+        "-map", f"[{last_v}]",
+        "-map", f"[{last_a}]" if last_a == "aout" else last_a,
+        "-c:v", "libx264", "-preset", preset, "-b:v", "5000k", "-pix_fmt", "yuv420p", "-r", "30",
+        "-c:a", "aac",
+        "-t", f"{voice_duration:.3f}",
+        output_path
+    ]
+    result = subprocess.run(cmd, input=bytes(voice_audio.pcm) if voice_audio else None,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"FFmpeg render 1 lượt lỗi: {result.stderr.decode(errors='ignore')[-2000:]}")
+    print(f"✅ Xuất video hoàn tất (1 lượt encode): {output_path}")
+
+
+def render_video(media_files, voice, output_path, temp_video, ass_path=None, is_vertical=True, crop=True,
+                 bg_music_path=None, bg_music_volume=30, font_name=None, font_size="14", font_color="#FFFFFF",
+                 word_count=0, fused=True):
+    """Render video cuối: thử render 1 lượt (fused) trước, lỗi thì quay về đường cũ nhiều bước."""
+    if fused:
+        try:
+            render_video_fused(media_files, voice, output_path, ass_path=ass_path, is_vertical=is_vertical,
+                               crop=crop, bg_music_path=bg_music_path, bg_music_volume=bg_music_volume)
+            return "fused"
+        except Exception as e:
+            print(f"⚠️ Render 1 lượt thất bại, chuyển sang render nhiều bước: {e}")
+
+    voice_duration = voice.duration if isinstance(voice, VoiceAudio) else AudioFileClip(voice).duration
+    create_video_randomized_media(
+        media_files=media_files,
+        total_duration=voice_duration,
+        change_every=5,
+        word_count=word_count,
+        output_file=temp_video,
+        is_vertical=is_vertical,
+        crop=crop
+    )
+    burn_sub_and_audio(
+        video_path=temp_video,
+        srt_path=ass_path,
+        voice_path=voice,
+        output_path=output_path,
+        font_name=font_name,
+        font_size=font_size,
+        font_color=font_color,
+        bg_music_path=bg_music_path,
+        bg_music_volume=bg_music_volume
+    )
+    return "multi"
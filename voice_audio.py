@@ -0,0 +1,201 @@
+import bisect
+import math
+import numpy as np
+from pydub import AudioSegment
+
+
+WHISPER_SAMPLE_RATE = 16000
+PCM_FORMATS = {1: "u8", 2: "s16le", 4: "s32le"}
+RESAMPLE_HALF_TAPS = 10  # Độ dài bộ lọc chống alias (mỗi bên, tính theo chu kỳ của tần số thấp hơn)
+
+
+def resample_poly(samples, up, down, half_taps=RESAMPLE_HALF_TAPS, block=65536):
+    """
+    Đổi tần số lấy mẫu theo tỉ lệ up / down (giống scipy.signal.resample_poly):
+    chèn 0, lọc thông thấp windowed-sinc dưới Nyquist của tần số đích để không bị alias, rồi lấy 1 mẫu mỗi down.
+    Chỉ tính các mẫu đầu ra cần thiết (polyphase): mỗi mẫu là tích vô hướng của 1 pha bộ lọc với 1 cửa sổ tín hiệu gốc.
+    """
+    g = math.gcd(up, down)
+    up, down = up // g, down // g
+    n_out = (len(samples) * up + down - 1) // down
+    ratio = max(up, down)
+    n_taps = 2 * half_taps * ratio + 1
+    t = np.arange(n_taps) - (n_taps - 1) / 2
+    h = (np.sinc(t / ratio) / ratio * np.kaiser(n_taps, 5.0) * up).astype(np.float32)
+    delay = (n_taps - 1) // 2
+
+    # y[k] = sum_j h[j] * x_up[k*down + delay - j], x_up chỉ khác 0 tại các chỉ số chia hết cho up
+    # -> với pha p = (k*down + delay) % up: y[k] = sum_i h[p + up*i] * x[n - i], n = (k*down + delay - p) / up
+    taps = -(-n_taps // up)
+    h = np.concatenate((h, np.zeros(taps * up - n_taps, dtype=np.float32)))
+    x = np.concatenate((np.zeros(taps - 1, dtype=np.float32), samples.astype(np.float32),
+                        np.zeros(taps + delay // up + 1, dtype=np.float32)))
+    windows = np.lib.stride_tricks.sliding_window_view(x, taps)  # windows[n] = x[n - taps + 1 .. n]
+    positions = np.arange(n_out, dtype=np.int64) * down + delay
+    out = np.empty(n_out, dtype=np.float32)
+    for phase in range(up):
+        ks = np.flatnonzero(positions % up == phase)
+        idx = (positions[ks] - phase) // up
+        sub = h[phase::up][::-1].copy()
+        for b in range(0, len(ks), block):
+            out[ks[b:b + block]] = windows[idx[b:b + block]] @ sub
+    return out
+
+
+class VoiceAudio:
+    """
+    Voice PCM giữ trong RAM, tạo 1 lần từ bytes API.
+    Whisper, đo độ dài và mix nhạc nền đều đọc từ đây thay vì decode lại file mp3.
+    """
+
+    __slots__ = ("pcm", "sample_rate", "sample_width", "channels")
+
+    def __init__(self, pcm, sample_rate=24000, sample_width=2, channels=1):
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.channels = channels
+
+    @property
+    def num_frames(self):
+        return len(self.pcm) // (self.sample_width * self.channels)
+
+    @property
+    def duration(self):
+        return self.num_frames / self.sample_rate
+
+    @property
+    def ffmpeg_format(self):
+        return PCM_FORMATS[self.sample_width]
+
+    def to_samples(self):
+        """Mảng float32 mono trong khoảng [-1, 1] ở sample_rate gốc."""
+        dtype = {1: np.uint8, 2: np.int16, 4: np.int32}[self.sample_width]
+        samples = np.frombuffer(self.pcm, dtype=dtype).astype(np.float32)
+        if self.sample_width == 1:
+            samples = (samples - 128.0) / 128.0
+        else:
+            samples /= float(2 ** (8 * self.sample_width - 1))
+        if self.channels > 1:
+            samples = samples.reshape(-1, self.channels).mean(axis=1)
+        return samples
+
+    def to_whisper_array(self, sample_rate=WHISPER_SAMPLE_RATE):
+        """Mảng float32 mono 16kHz, đưa thẳng vào WhisperModel.transcribe."""
+        samples = self.to_samples()
+        if self.sample_rate == sample_rate or len(samples) == 0:
+            return samples
+        # Lọc chống alias trước khi giảm mẫu (nội suy tuyến tính đơn thuần gập tần số > 8kHz vào dải tiếng nói)
+        return resample_poly(samples, sample_rate, self.sample_rate)
+
+    def to_audio_segment(self):
+        """AudioSegment của pydub dựng trực tiếp từ PCM (không decode)."""
+        return AudioSegment(
+            data=self.pcm,
+            sample_width=self.sample_width,
+            frame_rate=self.sample_rate,
+            channels=self.channels
+        )
+
+    @classmethod
+    def from_audio_segment(cls, segment):
+        return cls(segment.raw_data, sample_rate=segment.frame_rate,
+                   sample_width=segment.sample_width, channels=segment.channels)
+
+    def compact_silence(self, threshold_db=-40.0, max_pause=0.5, edge_pad=0.05, frame_ms=20):
+        """
+        Cắt khoảng lặng 2 đầu (giữ edge_pad giây) và rút các quãng nghỉ bên trong xuống tối đa max_pause giây.
+        Trả về (VoiceAudio mới, TimingMap) - TimingMap đổi mốc thời gian audio gốc sang audio đã rút gọn.
+        """
+        frame_len = max(1, int(self.sample_rate * frame_ms / 1000))
+        samples = self.to_samples()
+        n_frames = len(samples) // frame_len
+        if n_frames == 0:
+            return self, TimingMap([(0.0, self.duration, 0.0)])
+
+        # Năng lượng RMS từng frame (dBFS) -> frame có tiếng nói
+        frames = samples[:n_frames * frame_len].reshape(n_frames, frame_len)
+        rms = np.sqrt(np.mean(frames.astype(np.float64) ** 2, axis=1))
+        voiced = 20 * np.log10(np.maximum(rms, 1e-10)) > threshold_db
+        if not voiced.any():
+            return self, TimingMap([(0.0, self.duration, 0.0)])
+
+        # Các đoạn có tiếng [start, end) tính theo sample
+        edges = np.diff(np.concatenate(([0], voiced.astype(np.int8), [0])))
+        runs = [(int(start) * frame_len, int(end) * frame_len)
+                for start, end in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))]
+
+        total = self.num_frames
+        pad = int(edge_pad * self.sample_rate)
+        half_pause = int(max_pause * self.sample_rate / 2)
+        keep = [[max(0, runs[0][0] - pad), runs[0][1]]]
+        for start, end in runs[1:]:
+            gap_start = keep[-1][1]
+            if start - gap_start > 2 * half_pause:
+                # Giữ phần đuôi câu trước + phần đầu câu sau, bỏ đoạn lặng ở giữa
+                keep[-1][1] = gap_start + half_pause
+                keep.append([start - half_pause, end])
+            else:
+                keep[-1][1] = end
+        keep[-1][1] = min(total, keep[-1][1] + pad)
+
+        frame_bytes = self.sample_width * self.channels
+        pcm = b"".join(bytes(self.pcm[start * frame_bytes:end * frame_bytes]) for start, end in keep)
+
+        segments = []
+        dst = 0
+        for start, end in keep:
+            segments.append((start / self.sample_rate, end / self.sample_rate, dst / self.sample_rate))
+            dst += end - start
+        compacted = VoiceAudio(pcm, sample_rate=self.sample_rate, sample_width=self.sample_width,
+                               channels=self.channels)
+        return compacted, TimingMap(segments)
+
+
+class TimingMap:
+    """Các đoạn được giữ lại (src_start, src_end, dst_start) tính bằng giây, theo thứ tự thời gian."""
+
+    __slots__ = ("segments", "_src_starts")
+
+    def __init__(self, segments):
+        self.segments = segments
+        self._src_starts = [seg[0] for seg in segments]
+
+    @property
+    def kept_duration(self):
+        return sum(src_end - src_start for src_start, src_end, _ in self.segments)
+
+    def map_time(self, t):
+        """Mốc t (giây) trong audio gốc -> mốc tương ứng trong audio đã rút gọn."""
+        i = bisect.bisect_right(self._src_starts, t) - 1
+        if i < 0:
+            return 0.0
+        src_start, src_end, dst_start = self.segments[i]
+        return dst_start + min(t, src_end) - src_start
+
+
+def split_at_silence(samples, sample_rate=WHISPER_SAMPLE_RATE, max_seconds=30.0, search_seconds=5.0, frame_ms=100):
+    """
+    Chia mảng samples thành các đoạn (start, end) (tính theo sample) dài tối đa max_seconds.
+    Mỗi điểm cắt là frame nhỏ tiếng nhất trong search_seconds cuối của cửa sổ -> ít khi cắt giữa từ.
+    """
+    total = len(samples)
+    max_len = int(max_seconds * sample_rate)
+    search_len = min(int(search_seconds * sample_rate), max_len // 2)
+    frame_len = max(1, int(sample_rate * frame_ms / 1000))
+    spans = []
+    start = 0
+    while total - start > max_len:
+        window_start = start + max_len - search_len
+        window = np.asarray(samples[window_start:start + max_len], dtype=np.float32)
+        n_frames = len(window) // frame_len
+        if n_frames:
+            energy = np.square(window[:n_frames * frame_len]).reshape(n_frames, frame_len).mean(axis=1)
+            cut = window_start + int(np.argmin(energy)) * frame_len + frame_len // 2
+        else:
+            cut = start + max_len
+        spans.append((start, cut))
+        start = cut
+    if total > start:
+        spans.append((start, total))
+    return spans
@@ -1,20 +1,38 @@
 import os
+import gzip
 import json
 import random
+import hashlib
+import shutil
+import uuid
 import requests
-from faster_whisper import WhisperModel
+from faster_whisper import WhisperModel, decode_audio
 import base64
 import ffmpeg
 import time
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait as wait_futures, FIRST_COMPLETED
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
 import re
 from pathlib import Path
+from types import SimpleNamespace
+from voice_audio import VoiceAudio, WHISPER_SAMPLE_RATE, split_at_silence
+from subtitle_track import SubtitleTrack
+from disk_cache import evict_cache_dir, KeyLocks
 
 
-def get_proxy_list():
+# Địa chỉ API có thể đổi qua biến môi trường (ví dụ trỏ về mock_server.py khi benchmark offline)
+API_SERVER = os.environ.get("CREATOR_API_SERVER", "http://62.171.131.164:5000")
+PROXY_LIST_URL = f"{API_SERVER}/api/get_proxies"
+API_KEYS_URL = f"{API_SERVER}/api/get_gemini_keys"
+LANGUAGES_URL = f"{API_SERVER}/api/get_gemini_languages"
+
+
+def get_proxy_list(url=PROXY_LIST_URL):
     try:
-        res = requests.get("http://62.171.131.164:5000/api/get_proxies", timeout=5)
+        res = requests.get(url, timeout=5)
         if res.status_code == 200:
             proxy_list = res.json().get("proxies", [])
             if proxy_list:
@@ -44,39 +62,194 @@ def format_proxy(raw_proxy):
         raise ValueError(f"❌ Proxy không đúng định dạng: {raw_proxy}")
 
 
+# Pool proxy dùng chung: cache danh sách theo TTL, chấm điểm từng proxy, giữ session keep-alive
+PROXY_LIST_TTL = 300  # giây
+PROXY_EWMA_ALPHA = 0.3
+PROXY_EJECT_AFTER_FAILURES = 3  # Số lần lỗi liên tiếp trước khi tạm loại proxy
+PROXY_EJECT_SECONDS = 60
+PROXY_POOL_MAXSIZE = 10  # Số kết nối giữ lại cho mỗi session
+
+
+class ProxyState:
+    __slots__ = ("raw", "success_rate", "latency", "failures", "ejected_until", "requests", "session")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.success_rate = 1.0  # Proxy mới được coi là tốt để còn được thử
+        self.latency = 1.0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.session = None
+
+
+class ProxyPool:
+    """
+    ✅ Danh sách proxy được cache theo TTL thay vì gọi API mỗi lần
+    ✅ Theo dõi tỉ lệ thành công + độ trễ (EWMA) của từng proxy
+    ✅ Tạm loại proxy lỗi liên tiếp, ưu tiên proxy nhanh khi chọn
+    ✅ Mỗi proxy có 1 requests.Session riêng để tái sử dụng kết nối / TLS
+    """
+
+    def __init__(self, url=PROXY_LIST_URL, ttl=PROXY_LIST_TTL, alpha=PROXY_EWMA_ALPHA,
+                 eject_after=PROXY_EJECT_AFTER_FAILURES, eject_seconds=PROXY_EJECT_SECONDS):
+        self.url = url
+        self.ttl = ttl
+        self.alpha = alpha
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self._states = {}
+        self._direct = ProxyState(None)
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """Lấy lại danh sách proxy nếu đã hết TTL (giữ nguyên điểm của proxy cũ)."""
+        with self._refresh_lock:
+            if not force and time.time() - self._fetched_at < self.ttl:
+                return
+            proxy_list = get_proxy_list(self.url)
+            if not proxy_list and self._states:
+                return  # Lỗi tạm thời -> giữ danh sách cũ, lần sau lấy lại
+            with self._lock:
+                self._fetched_at = time.time()
+                old_states = self._states
+                self._states = {raw: old_states.pop(raw, None) or ProxyState(raw) for raw in proxy_list}
+            for state in old_states.values():
+                if state.session:
+                    state.session.close()
+
+    def _state(self, raw):
+        return self._direct if raw is None else self._states.get(raw)
+
+    def ordered(self, limit=None):
+        """Danh sách proxy còn dùng được, xáo trộn có trọng số (nhanh + ổn định đứng trước)."""
+        self.refresh()
+        now = time.time()
+        with self._lock:
+            states = list(self._states.values())
+        if not states:
+            return [None]  # Không có proxy -> gọi trực tiếp
+
+        available = [st for st in states if st.ejected_until <= now]
+        if not available:
+            # Tất cả đều đang bị loại -> dùng những proxy sắp hết hạn loại trước
+            available = sorted(states, key=lambda st: st.ejected_until)[:max(1, limit or 1)]
+
+        # Weighted sampling không lặp (Efraimidis-Spirakis): key = u^(1/w)
+        def sort_key(st):
+            weight = max(st.success_rate, 0.01) / max(st.latency, 0.05)
+            return random.random() ** (1.0 / weight)
+
+        ordered = [st.raw for st in sorted(available, key=sort_key, reverse=True)]
+        return ordered[:limit] if limit else ordered
+
+    def choose(self):
+        return self.ordered(limit=1)[0]
+
+    def session(self, raw):
+        """
+        Session keep-alive gắn với proxy (raw=None = kết nối trực tiếp).
+        Proxy vừa bị xóa khỏi danh sách thì trả về None: gọi thẳng requests với proxies=format_proxy(raw),
+        không tạo session mới mà không ai đóng.
+        """
+        state = self._state(raw)
+        if state is None:
+            return None
+        with self._lock:
+            if state.session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=PROXY_POOL_MAXSIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                if raw is not None:
+                    session.proxies.update(format_proxy(raw))
+                state.session = session
+            return state.session
+
+    def report(self, raw, ok, latency):
+        state = self._state(raw)
+        if state is None:
+            return
+        with self._lock:
+            state.requests += 1
+            state.success_rate += self.alpha * ((1.0 if ok else 0.0) - state.success_rate)
+            if ok:
+                state.latency += self.alpha * (latency - state.latency)
+                state.failures = 0
+            else:
+                state.failures += 1
+                if state.failures >= self.eject_after:
+                    state.ejected_until = time.time() + self.eject_seconds
+                    state.failures = 0
+                    print(f"🚫 Tạm loại proxy {raw} trong {self.eject_seconds}s")
+
+    @contextmanager
+    def track(self, raw):
+        """
+        Đo thời gian 1 request qua proxy và cập nhật điểm: lỗi kết nối tính là proxy lỗi,
+        lỗi khác (API trả 4xx/5xx, request bị hủy khi hedge) không cập nhật gì.
+        """
+        start = time.time()
+        try:
+            yield
+        except requests.RequestException:
+            self.report(raw, False, time.time() - start)
+            raise
+        self.report(raw, True, time.time() - start)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                raw: {
+                    "success_rate": round(st.success_rate, 3),
+                    "latency": round(st.latency, 3),
+                    "requests": st.requests,
+                    "ejected": st.ejected_until > now
+                }
+                for raw, st in self._states.items()
+            }
+
+
+proxy_pool = ProxyPool()
+
+
 def send_with_proxy_retry(method, url, headers=None, json_data=None, files_path=None, data=None, max_retries=5):
-    proxy_list = get_proxy_list()
-    random.shuffle(proxy_list)
+    proxy_list = [p for p in proxy_pool.ordered(limit=max_retries) if p]
 
-    for attempt, raw_proxy in enumerate(proxy_list[:max_retries], 1):
+    for attempt, raw_proxy in enumerate(proxy_list, 1):
         try:
-            proxy = format_proxy(raw_proxy)
+            session = proxy_pool.session(raw_proxy)
+            proxies = None if session else format_proxy(raw_proxy)
             print(f"🔁 [Thử {attempt}] Đang thử với proxy: {raw_proxy}")
 
-            if files_path:
-                file_key, file_path, mime = files_path
-                with open(file_path, "rb") as f:
-                    files = {file_key: (os.path.basename(file_path), f, mime)}
-                    res = requests.request(
+            with proxy_pool.track(raw_proxy):
+                if files_path:
+                    file_key, file_path, mime = files_path
+                    with open(file_path, "rb") as f:
+                        files = {file_key: (os.path.basename(file_path), f, mime)}
+                        res = (session or requests).request(
+                            method=method,
+                            url=url,
+                            headers=headers,
+                            json=json_data,
+                            files=files,
+                            data=data,
+                            proxies=proxies,
+                            timeout=15
+                        )
+                else:
+                    res = (session or requests).request(
                         method=method,
                         url=url,
                         headers=headers,
                         json=json_data,
-                        files=files,
                         data=data,
-                        proxies=proxy,
+                        proxies=proxies,
                         timeout=15
                     )
-            else:
-                res = requests.request(
-                    method=method,
-                    url=url,
-                    headers=headers,
-                    json=json_data,
-                    data=data,
-                    proxies=proxy,
-                    timeout=15
-                )
 
             if res.status_code == 200:
                 return res
@@ -92,8 +265,7 @@ def send_with_proxy_retry(method, url, headers=None, json_data=None, files_path=
 
 def fetch_api_keys():
     """Fetch the list of available Gemini API keys."""
-    url = "http://62.171.131.164:5000/api/get_gemini_keys"
-    response = requests.get(url)
+    response = requests.get(API_KEYS_URL)
 
     if response.status_code == 200:
         keys_data = response.json()
@@ -103,82 +275,400 @@ def fetch_api_keys():
         return []
 
 
-def create_voice_with_retry(text, output_file_pcm, api_key_list, voice_name="achird", max_workers=5):
-    """
-    ✅ Tạo voice sử dụng nhiều key và proxy cùng lúc (song song)
-    ✅ Dừng lại khi 1 key thành công
-    """
-    proxy_list = get_proxy_list()
-    if not proxy_list:
-        proxy_list = [None]
+# Lập lịch key theo quota: mỗi key có 1 token bucket, key bị 429 sẽ được cho nghỉ
+KEY_RATE_PER_MINUTE = 10  # Tốc độ nạp lại token của mỗi key
+KEY_BURST = 3  # Số request tối đa được dồn liên tiếp trên 1 key
+KEY_COOLDOWN_SECONDS = 60  # Thời gian nghỉ mặc định khi bị 429 mà không có Retry-After
+KEY_INVALID_COOLDOWN_SECONDS = 600  # Key hết quota / không hợp lệ (401, 403)
 
-    success_event = threading.Event()
-    result_holder = {}
-    lock = threading.Lock()
 
-    def task(api_key, proxy_str, thread_id):
-        if success_event.is_set():
-            return
+class TTSApiError(Exception):
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"Lỗi API: {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
 
+def parse_retry_after(headers, body=""):
+    """Đọc thời gian chờ (giây) từ header Retry-After hoặc retryDelay trong body lỗi của Gemini."""
+    value = headers.get("Retry-After")
+    if value:
         try:
-            proxy_dict = format_proxy(proxy_str) if proxy_str else None
-            print(f"[{thread_id}] 🧪 Thử key: {api_key[:10]}... với proxy: {proxy_str}")
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    match = re.search(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"', body[:4096])
+    return float(match.group(1)) if match else None
+
+
+class KeyState:
+    __slots__ = ("key", "tokens", "updated_at", "cooldown_until", "strikes", "used", "rejected")
+
+    def __init__(self, key, burst):
+        self.key = key
+        self.tokens = float(burst)
+        self.updated_at = time.time()
+        self.cooldown_until = 0.0
+        self.strikes = 0
+        self.used = 0
+        self.rejected = 0
+
+
+class KeyScheduler:
+    """
+    ✅ Token bucket cho từng key, luôn chọn key còn nhiều "headroom" nhất
+    ✅ Đọc 429 + Retry-After để cho key nghỉ, key lỗi 401/403 nghỉ lâu hơn
+    ✅ Đếm số lần dùng / bị từ chối của từng key để ghi log batch
+    """
 
-            url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-tts:generateContent"
-            data = {
-                "contents": [{"parts": [{"text": text}]}],
-                "generationConfig": {
-                    "responseModalities": ["AUDIO"],
-                    "speechConfig": {
-                        "voiceConfig": {
-                            "prebuiltVoiceConfig": {
-                                "voiceName": voice_name
-                            }
-                        }
-                    }
-                },
-                "model": "gemini-2.5-flash-preview-tts",
+    def __init__(self, rate_per_minute=KEY_RATE_PER_MINUTE, burst=KEY_BURST, cooldown=KEY_COOLDOWN_SECONDS):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.cooldown = cooldown
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = KeyState(key, self.burst)
+        return state
+
+    def _refill(self, state, now):
+        state.tokens = min(self.burst, state.tokens + (now - state.updated_at) * self.rate)
+        state.updated_at = now
+
+    def acquire(self, api_key_list, exclude=(), wait=0):
+        """
+        Lấy key có nhiều token nhất (bỏ qua key đang nghỉ hoặc chưa đủ 1 token).
+        Không có key nào sẵn sàng thì chờ tới lúc key sớm nhất sẵn sàng (tối đa wait giây), quá hạn trả về None.
+        """
+        deadline = time.time() + wait
+        while True:
+            now = time.time()
+            with self._lock:
+                best = None
+                next_ready = None
+                for key in api_key_list:
+                    if key in exclude:
+                        continue
+                    state = self._get(key)
+                    self._refill(state, now)
+                    if state.cooldown_until > now:
+                        ready_at = state.cooldown_until
+                    elif state.tokens < 1:
+                        ready_at = now + (1 - state.tokens) / self.rate
+                    else:
+                        ready_at = None
+                    if ready_at is not None:
+                        next_ready = ready_at if next_ready is None else min(next_ready, ready_at)
+                        continue
+                    if best is None or (state.tokens, -state.used) > (best.tokens, -best.used):
+                        best = state
+                if best is not None:
+                    best.tokens -= 1
+                    best.used += 1
+                    return best.key
+            if next_ready is None or next_ready > deadline:
+                return None
+            time.sleep(max(0.05, next_ready - time.time()))
+
+    def report(self, key, status_code, retry_after=None):
+        with self._lock:
+            state = self._get(key)
+            if status_code == 200:
+                state.strikes = 0
+                return
+            if status_code == 429:
+                state.rejected += 1
+                state.strikes += 1
+                delay = retry_after if retry_after is not None else self.cooldown * 2 ** min(state.strikes - 1, 3)
+                state.tokens = 0.0
+                state.cooldown_until = max(state.cooldown_until, time.time() + delay)
+                print(f"⏸️ Key {key[:10]}... bị giới hạn (429), nghỉ {delay:.0f}s")
+            elif status_code in (401, 403):
+                state.rejected += 1
+                state.cooldown_until = time.time() + KEY_INVALID_COOLDOWN_SECONDS
+                print(f"⛔ Key {key[:10]}... bị từ chối ({status_code}), tạm bỏ qua")
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                key[:10]: {
+                    "used": st.used,
+                    "rejected": st.rejected,
+                    "tokens": round(st.tokens, 2),
+                    "cooling": st.cooldown_until > now
+                }
+                for key, st in self._states.items()
             }
 
-            response = requests.post(
-                url,
-                headers={"x-goog-api-key": api_key, "Content-Type": "application/json"},
-                json=data,
-                proxies=proxy_dict,
-                timeout=60
-            )
 
-            if response.status_code != 200:
-                print(f"❌ [{thread_id}] Lỗi API: {response.status_code}")
-                return
+key_scheduler = KeyScheduler()
+
+
+# Cache voice TTS trên đĩa (content-addressed, LRU theo mtime)
+TTS_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta/models")
+TTS_MODEL_ID = "gemini-2.5-flash-preview-tts"
+TTS_OUTPUT_FORMAT = "mp3"
+TTS_CACHE_DIR = os.path.join("cache", "tts")
+TTS_CACHE_MAX_BYTES = 500 * 1024 * 1024
+_tts_cache_stats = {"hit": 0, "miss": 0}
+_tts_cache_lock = threading.Lock()
+
+
+def tts_cache_key(text, voice_name, model_id=TTS_MODEL_ID, output_format=TTS_OUTPUT_FORMAT):
+    """Hash của (text, voice, model, định dạng) dùng làm tên file trong cache."""
+    payload = json.dumps([text, voice_name, model_id, output_format], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _tts_cache_path(key, output_format=TTS_OUTPUT_FORMAT):
+    return os.path.join(TTS_CACHE_DIR, f"{key}.{output_format}")
+
+
+def _count_tts_cache(hit):
+    with _tts_cache_lock:
+        _tts_cache_stats["hit" if hit else "miss"] += 1
+
+
+def tts_cache_get(key, output_file, output_format=TTS_OUTPUT_FORMAT):
+    """Copy file cache ra output_file. Trả về True nếu hit."""
+    cache_path = _tts_cache_path(key, output_format)
+    try:
+        shutil.copyfile(cache_path, output_file)
+        os.utime(cache_path)  # Đánh dấu vừa dùng (LRU)
+    except OSError:
+        _count_tts_cache(False)
+        return False
+    _count_tts_cache(True)
+    return True
+
+
+def tts_cache_get_bytes(key, output_format="pcm"):
+    """Đọc thẳng nội dung cache vào RAM. Trả về None nếu miss."""
+    cache_path = _tts_cache_path(key, output_format)
+    try:
+        with open(cache_path, "rb") as f:
+            data = f.read()
+        os.utime(cache_path)
+    except OSError:
+        _count_tts_cache(False)
+        return None
+    _count_tts_cache(True)
+    return data
+
+
+def tts_cache_put(key, audio_file, output_format=TTS_OUTPUT_FORMAT):
+    """Lưu audio vào cache bằng ghi tạm + os.replace để job khác không đọc phải file dở."""
+    try:
+        os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+        cache_path = _tts_cache_path(key, output_format)
+        temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(audio_file, temp_path)
+        os.replace(temp_path, cache_path)
+        evict_tts_cache()
+    except OSError as e:
+        print(f"⚠️ Không thể lưu voice vào cache: {e}")
+
+
+def tts_cache_put_bytes(key, data, output_format="pcm"):
+    try:
+        os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+        cache_path = _tts_cache_path(key, output_format)
+        temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, cache_path)
+        evict_tts_cache()
+    except OSError as e:
+        print(f"⚠️ Không thể lưu voice vào cache: {e}")
+
+
+def evict_tts_cache(max_bytes=None):
+    evict_cache_dir(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES if max_bytes is None else max_bytes)
+
+
+def get_tts_cache_stats():
+    with _tts_cache_lock:
+        return dict(_tts_cache_stats)
 
-            if success_event.is_set():
-                return
 
-            success_event.set()
+TTS_SAMPLE_RATE = 24000  # Gemini trả về PCM s16le 24kHz mono
+TTS_SAMPLE_WIDTH = 2
+TTS_STREAM_BLOCK_SIZE = 64 * 1024
+_INLINE_DATA_RE = re.compile(rb'"inlineData"\s*:\s*\{[^}]*?"data"\s*:\s*"')
 
-            audio_data = response.json()['candidates'][0]['content']['parts'][0]['inlineData']['data']
-            decoded_audio = base64.b64decode(audio_data)
 
-            unique_id = random.randint(1000, 9999)
-            temp_pcm = output_file_pcm.replace(".pcm", f"_{unique_id}.pcm")
-            with open(temp_pcm, "wb") as f:
-                f.write(decoded_audio)
+class TTSCancelled(Exception):
+    pass
 
-            base_name, _ = os.path.splitext(temp_pcm)
-            timestamp = time.strftime("%Y%m%d%H%M%S")
-            mp3_file = f"{base_name}_{timestamp}.mp3"
 
-            ffmpeg.input(temp_pcm, f='s16le', ar='24000', ac='1') \
-                .output(mp3_file, **{'y': None}) \
-                .run(overwrite_output=True, quiet=True)
+class InlineAudioDecoder:
+    """
+    Nhận body JSON theo từng block, chỉ lấy chuỗi base64 của inlineData.data
+    và decode dần vào `out` (bytearray hoặc file) -> không giữ cả body / dict / chuỗi base64 trong RAM.
+    """
+
+    def __init__(self, out):
+        self.write = out.extend if isinstance(out, bytearray) else out.write
+        self.buf = b""
+        self.pending = b""  # Phần base64 chưa đủ bội số 4
+        self.in_value = False
+
+    def feed(self, block):
+        """Trả về True khi đã đọc xong chuỗi base64."""
+        self.buf += block
+        if not self.in_value:
+            match = _INLINE_DATA_RE.search(self.buf)
+            if not match:
+                self.buf = self.buf[-1024:]  # Giữ lại phần đuôi phòng khi key bị cắt giữa 2 block
+                return False
+            self.in_value = True
+            self.buf = self.buf[match.end():]
+
+        end = self.buf.find(b'"')
+        piece = self.buf if end < 0 else self.buf[:end]
+        self.buf = b""
+        # JSON có thể escape "/" thành "\/", base64 hợp lệ không chứa "\"
+        self.pending += piece.replace(b"\\", b"")
+        usable = len(self.pending) - len(self.pending) % 4
+        if usable:
+            self.write(base64.b64decode(self.pending[:usable]))
+            self.pending = self.pending[usable:]
+        if end < 0:
+            return False
+        if self.pending:
+            self.write(base64.b64decode(self.pending + b"=" * (-len(self.pending) % 4)))
+        return True
+
+
+def stream_inline_audio(response, out, block_size=TTS_STREAM_BLOCK_SIZE, cancel_event=None):
+    """Đọc response (requests, stream=True) và decode audio dần vào `out`."""
+    decoder = InlineAudioDecoder(out)
+    for block in response.iter_content(chunk_size=block_size):
+        if cancel_event is not None and cancel_event.is_set():
+            raise TTSCancelled("Đã có request khác thành công")
+        if decoder.feed(block):
+            return
 
-            os.remove(temp_pcm)
-            print(f"🧹 Đã xóa file PCM tạm: {temp_pcm}")
-            print(f"✅ Voice generated successfully. Saved as {mp3_file}")
+    raise Exception("Không tìm thấy inlineData.data trong response")
+
+
+def build_tts_payload(text, voice_name):
+    return {
+        "contents": [{"parts": [{"text": text}]}],
+        "generationConfig": {
+            "responseModalities": ["AUDIO"],
+            "speechConfig": {
+                "voiceConfig": {
+                    "prebuiltVoiceConfig": {
+                        "voiceName": voice_name
+                    }
+                }
+            }
+        },
+        "model": TTS_MODEL_ID,
+    }
+
+
+def request_tts_pcm(text, voice_name, api_key, proxy_dict=None, timeout=60, session=None, cancel_event=None):
+    """Gọi Gemini TTS 1 lần, trả về PCM thô (bytearray). Lỗi HTTP sẽ raise TTSApiError."""
+    url = f"{TTS_API_BASE}/{TTS_MODEL_ID}:generateContent"
+    data = build_tts_payload(text, voice_name)
+
+    if cancel_event is not None and cancel_event.is_set():
+        raise TTSCancelled("Đã có request khác thành công")
+
+    with (session or requests).post(
+        url,
+        headers={"x-goog-api-key": api_key, "Content-Type": "application/json"},
+        json=data,
+        proxies=proxy_dict,
+        timeout=timeout,
+        stream=True
+    ) as response:
+        if response.status_code != 200:
+            retry_after = parse_retry_after(response.headers, response.text) if response.status_code == 429 else None
+            raise TTSApiError(response.status_code, retry_after)
+
+        pcm = bytearray()
+        stream_inline_audio(response, pcm, cancel_event=cancel_event)
+        return pcm
+
+
+def tts_attempt(text, voice_name, api_key, proxy_str, cancel_event=None):
+    """1 lần gọi TTS qua proxy_pool, cập nhật điểm proxy và quota key."""
+    session = proxy_pool.session(proxy_str)
+    proxy_dict = None if session else format_proxy(proxy_str)
+    _count_tts_attempt("attempts")
+    try:
+        with proxy_pool.track(proxy_str):
+            pcm = request_tts_pcm(text, voice_name, api_key, proxy_dict=proxy_dict, session=session,
+                                  cancel_event=cancel_event)
+    except TTSApiError as e:
+        key_scheduler.report(api_key, e.status_code, e.retry_after)
+        raise
+    key_scheduler.report(api_key, 200)
+    return pcm
+
+
+def save_pcm_as_mp3(pcm_bytes, output_file_pcm):
+    """Ghi PCM ra file tạm rồi encode sang mp3, trả về đường dẫn mp3."""
+    unique_id = random.randint(1000, 9999)
+    temp_pcm = output_file_pcm.replace(".pcm", f"_{unique_id}.pcm")
+    with open(temp_pcm, "wb") as f:
+        f.write(pcm_bytes)
+
+    base_name, _ = os.path.splitext(temp_pcm)
+    timestamp = time.strftime("%Y%m%d%H%M%S")
+    mp3_file = f"{base_name}_{timestamp}.mp3"
+
+    ffmpeg.input(temp_pcm, f='s16le', ar=str(TTS_SAMPLE_RATE), ac='1') \
+        .output(mp3_file, **{'y': None}) \
+        .run(overwrite_output=True, quiet=True)
+
+    os.remove(temp_pcm)
+    print(f"🧹 Đã xóa file PCM tạm: {temp_pcm}")
+    print(f"✅ Voice generated successfully. Saved as {mp3_file}")
+    return mp3_file
+
+
+def _synthesize_pcm_fanout(text, api_key_list, voice_name="achird", max_workers=5):
+    """
+    ✅ Gọi TTS với nhiều key và proxy cùng lúc (song song)
+    ✅ Dừng lại khi 1 key thành công, trả về PCM thô
+    """
+    proxy_list = proxy_pool.ordered()
+    started = time.time()
+    _count_tts_attempt("requests")
+
+    success_event = threading.Event()
+    result_holder = {}
+    lock = threading.Lock()
+
+    def task(proxy_str, thread_id):
+        if success_event.is_set():
+            return
+
+        # Key được chọn lúc chạy: key nhiều headroom nhất, bỏ qua key đang bị giới hạn
+        api_key = key_scheduler.acquire(api_key_list)
+        if api_key is None:
+            return
+
+        try:
+            print(f"[{thread_id}] 🧪 Thử key: {api_key[:10]}... với proxy: {proxy_str}")
+            decoded_audio = tts_attempt(text, voice_name, api_key, proxy_str)
 
             with lock:
-                result_holder["result"] = mp3_file
+                if success_event.is_set():
+                    return
+                success_event.set()
+                result_holder["result"] = decoded_audio
 
         except Exception as e:
             print(f"❌ [{thread_id}] Key {api_key[:10]} lỗi: {e}")
@@ -188,22 +678,360 @@ def create_voice_with_retry(text, output_file_pcm, api_key_list, voice_name="ach
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         thread_id = 0
         for proxy_str in proxy_list:
-            for api_key in api_key_list:
+            for _ in api_key_list:
                 thread_id += 1
-                tasks.append(executor.submit(task, api_key, proxy_str, thread_id))
+                tasks.append(executor.submit(task, proxy_str, thread_id))
 
         for future in as_completed(tasks):
             if success_event.is_set():
                 break
 
     if "result" in result_holder:
+        tts_latency.add(time.time() - started, len(text))
         return result_holder["result"]
     else:
         raise Exception("🛑 Không có key nào khả dụng để tạo voice.")
 
 
+# Hedged request: gửi 1 request, chỉ gửi thêm khi request trước chậm hơn ngưỡng độ trễ
+TTS_STRATEGY = "hedged"  # "hedged" hoặc "fanout" (cách cũ: mọi proxy x key cùng lúc)
+TTS_HEDGE_PERCENTILE = 0.9
+TTS_HEDGE_MAX_INFLIGHT = 2
+TTS_HEDGE_MAX_ATTEMPTS = 6
+TTS_HEDGE_DEFAULT_DELAY = 10.0  # giây, dùng khi chưa đủ dữ liệu độ trễ
+TTS_HEDGE_MIN_SAMPLES = 5
+TTS_KEY_WAIT_SECONDS = 10  # Chờ key hết bị giới hạn khi cần thử lại
+
+
+class LatencyTracker:
+    """Lưu độ trễ các request TTS thành công gần đây (chuẩn hóa theo độ dài text)."""
+
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds, text_len):
+        with self._lock:
+            self._samples.append((seconds, max(text_len, 50)))
+
+    def percentile(self, q):
+        with self._lock:
+            values = sorted(seconds for seconds, _ in self._samples)
+        if not values:
+            return None
+        return values[int(q * (len(values) - 1))]
+
+    def hedge_delay(self, text_len):
+        with self._lock:
+            per_char = sorted(seconds / length for seconds, length in self._samples)
+        if len(per_char) < TTS_HEDGE_MIN_SAMPLES:
+            return TTS_HEDGE_DEFAULT_DELAY
+        return per_char[int(TTS_HEDGE_PERCENTILE * (len(per_char) - 1))] * max(text_len, 50)
+
+
+tts_latency = LatencyTracker()
+_tts_attempt_stats = {"requests": 0, "attempts": 0, "hedged": 0, "cancelled": 0}
+_tts_attempt_lock = threading.Lock()
+
+
+def _count_tts_attempt(name, value=1):
+    with _tts_attempt_lock:
+        _tts_attempt_stats[name] += value
+
+
+def get_tts_attempt_stats():
+    """Số request / attempt / hedge và độ trễ p50, p95 để so sánh hedged với fanout."""
+    with _tts_attempt_lock:
+        stats = dict(_tts_attempt_stats)
+    stats["attempts_per_request"] = round(stats["attempts"] / stats["requests"], 2) if stats["requests"] else 0
+    stats["p50"] = tts_latency.percentile(0.5)
+    stats["p95"] = tts_latency.percentile(0.95)
+    return stats
+
+
+def _synthesize_pcm_hedged(text, api_key_list, voice_name="achird", max_inflight=TTS_HEDGE_MAX_INFLIGHT,
+                           max_attempts=TTS_HEDGE_MAX_ATTEMPTS):
+    """
+    ✅ Gửi 1 request, nếu quá ngưỡng pXX độ trễ mà chưa xong thì gửi thêm (tối đa max_inflight cùng lúc)
+    ✅ Request lỗi -> thử lại ngay với key / proxy khác
+    ✅ Khi 1 request thành công, các request còn lại bị hủy ngay
+    """
+    proxy_list = proxy_pool.ordered()
+    hedge_delay = tts_latency.hedge_delay(len(text))
+    cancel_event = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max_inflight)
+    inflight = {}
+    attempts = 0
+    last_error = None
+    started = time.time()
+
+    def launch(key_wait=0):
+        nonlocal attempts
+        api_key = key_scheduler.acquire(api_key_list, wait=key_wait)
+        if api_key is None:
+            return False
+        proxy_str = proxy_list[attempts % len(proxy_list)]
+        attempts += 1
+        print(f"[{attempts}] 🧪 Thử key: {api_key[:10]}... với proxy: {proxy_str}")
+        future = executor.submit(tts_attempt, text, voice_name, api_key, proxy_str, cancel_event)
+        inflight[future] = api_key
+        return True
+
+    _count_tts_attempt("requests")
+    try:
+        launch(TTS_KEY_WAIT_SECONDS)
+        while inflight:
+            done, _ = wait_futures(list(inflight), timeout=hedge_delay, return_when=FIRST_COMPLETED)
+            if not done:
+                # Request hiện tại chậm hơn ngưỡng -> gửi thêm 1 request dự phòng
+                if len(inflight) < max_inflight and attempts < max_attempts and launch():
+                    _count_tts_attempt("hedged")
+                    print(f"⏱️ Quá {hedge_delay:.1f}s chưa có kết quả, gửi thêm request dự phòng")
+                continue
+
+            for future in done:
+                api_key = inflight.pop(future)
+                try:
+                    pcm = future.result()
+                except Exception as e:
+                    last_error = e
+                    print(f"❌ Key {api_key[:10]} lỗi: {e}")
+                    continue
+                tts_latency.add(time.time() - started, len(text))
+                return pcm
+
+            # Tất cả request vừa xong đều lỗi -> thử lại ngay
+            if not inflight and attempts < max_attempts:
+                launch(TTS_KEY_WAIT_SECONDS)
+    finally:
+        cancel_event.set()
+        if inflight:
+            _count_tts_attempt("cancelled", len(inflight))
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    raise Exception(f"🛑 Không có key nào khả dụng để tạo voice. ({last_error})")
+
+
+def synthesize_pcm(text, api_key_list, voice_name="achird", max_workers=5, strategy=None):
+    """Tạo PCM cho text theo chiến lược TTS_STRATEGY ("hedged" hoặc "fanout")."""
+    strategy = strategy or TTS_STRATEGY
+    if strategy == "fanout":
+        return _synthesize_pcm_fanout(text, api_key_list, voice_name=voice_name, max_workers=max_workers)
+    return _synthesize_pcm_hedged(text, api_key_list, voice_name=voice_name,
+                                  max_inflight=min(max_workers, TTS_HEDGE_MAX_INFLIGHT))
+
+
+def create_voice_with_retry(text, output_file_pcm, api_key_list, voice_name="achird", max_workers=5, use_cache=True):
+    """
+    ✅ Tạo voice và lưu thành file mp3
+    ✅ Dùng lại voice đã tạo trước đó nếu có trong cache
+    """
+    cache_key = tts_cache_key(text, voice_name) if use_cache else None
+    if cache_key:
+        base_name, _ = os.path.splitext(output_file_pcm)
+        timestamp = time.strftime("%Y%m%d%H%M%S")
+        cached_file = f"{base_name}_{timestamp}.{TTS_OUTPUT_FORMAT}"
+        if tts_cache_get(cache_key, cached_file):
+            print(f"♻️ Dùng lại voice từ cache: {cached_file}")
+            return cached_file
+
+    decoded_audio = synthesize_pcm(text, api_key_list, voice_name=voice_name, max_workers=max_workers)
+    mp3_file = save_pcm_as_mp3(decoded_audio, output_file_pcm)
+    if cache_key:
+        tts_cache_put(cache_key, mp3_file)
+    return mp3_file
+
+
+def create_voice_audio(text, api_key_list, voice_name="achird", max_workers=5, use_cache=True):
+    """
+    ✅ Tạo voice và giữ nguyên PCM trong RAM (VoiceAudio), không encode mp3
+    ✅ Các bước sau (whisper, đo độ dài, mix nhạc nền) dùng lại mà không cần decode
+    """
+    cache_key = tts_cache_key(text, voice_name, output_format="pcm") if use_cache else None
+    pcm = tts_cache_get_bytes(cache_key, "pcm") if cache_key else None
+    if pcm is not None:
+        print("♻️ Dùng lại voice PCM từ cache")
+    else:
+        pcm = synthesize_pcm(text, api_key_list, voice_name=voice_name, max_workers=max_workers)
+        if cache_key:
+            tts_cache_put_bytes(cache_key, pcm, "pcm")
+    return VoiceAudio(pcm, sample_rate=TTS_SAMPLE_RATE, sample_width=TTS_SAMPLE_WIDTH)
+
+
+def split_text_into_chunks(text, max_chars=300):
+    """Chia script thành các chunk theo ranh giới câu (cùng quy tắc dấu câu với split_text_smart)."""
+    sentences = []
+    sentence = ""
+    for phrase in split_phrases(text):
+        if not phrase:
+            continue
+        sentence = f"{sentence} {phrase}".strip()
+        if phrase[-1:] in SENTENCE_END_PUNCTUATION:
+            sentences.append(sentence)
+            sentence = ""
+    if sentence:
+        sentences.append(sentence)
+
+    # Gộp các câu liền nhau cho tới khi chạm max_chars
+    chunks = []
+    current = ""
+    for sentence in sentences:
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}".strip()
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def create_voice_chunked(text, output_file_pcm, api_key_list, voice_name="achird", max_workers=5,
+                         max_chars=300, pause=0.15, max_retries=3, save_mp3=True):
+    """
+    ✅ Tạo voice cho script dài: chia theo câu, tạo song song từng chunk trên nhiều key
+    ✅ Chunk lỗi chỉ thử lại riêng chunk đó
+    ✅ Ghép PCM liền mạch (có khoảng lặng `pause` giây giữa các chunk) rồi encode 1 lần
+
+    Trả về {"audio_path": mp3 (None nếu save_mp3=False), "audio": VoiceAudio,
+    "chunks": [{"text", "start", "end"}, ...]} với start/end tính bằng giây.
+    """
+    chunks = split_text_into_chunks(text, max_chars=max_chars)
+    if not chunks:
+        raise Exception("🛑 Không có nội dung để tạo voice.")
+
+    print(f"✂️ Chia script thành {len(chunks)} chunk")
+
+    def synth_chunk(chunk_idx, chunk_text):
+        last_error = None
+        for attempt in range(max_retries):
+            # Key nhiều headroom nhất, chờ tối đa 30s nếu tất cả key đang nghỉ
+            api_key = key_scheduler.acquire(api_key_list, wait=30)
+            if api_key is None:
+                last_error = Exception("Tất cả key đang bị giới hạn")
+                break
+            proxy_str = proxy_pool.choose()
+            try:
+                print(f"[chunk {chunk_idx + 1}] 🧪 Thử key: {api_key[:10]}... với proxy: {proxy_str}")
+                return tts_attempt(chunk_text, voice_name, api_key, proxy_str)
+            except Exception as e:
+                last_error = e
+                print(f"❌ [chunk {chunk_idx + 1}] Lần {attempt + 1} lỗi: {e}")
+        raise Exception(f"🛑 Chunk {chunk_idx + 1} thất bại sau {max_retries} lần: {last_error}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pcm_parts = list(executor.map(synth_chunk, range(len(chunks)), chunks))
+
+    bytes_per_second = TTS_SAMPLE_RATE * TTS_SAMPLE_WIDTH
+    silence = b"\x00" * (int(pause * TTS_SAMPLE_RATE) * TTS_SAMPLE_WIDTH)
+
+    joined = bytearray()
+    chunk_offsets = []
+    for i, (chunk_text, pcm) in enumerate(zip(chunks, pcm_parts)):
+        if i > 0:
+            joined += silence
+        start = len(joined) / bytes_per_second
+        joined += pcm
+        chunk_offsets.append({
+            "text": chunk_text,
+            "start": round(start, 3),
+            "end": round(len(joined) / bytes_per_second, 3)
+        })
+
+    pcm = bytes(joined)
+    mp3_file = save_pcm_as_mp3(pcm, output_file_pcm) if save_mp3 else None
+    return {
+        "audio_path": mp3_file,
+        "audio": VoiceAudio(pcm, sample_rate=TTS_SAMPLE_RATE, sample_width=TTS_SAMPLE_WIDTH),
+        "chunks": chunk_offsets
+    }
+
+
 # transcribe audio
 
+# Registry model whisper dùng chung cho cả process (LRU)
+WHISPER_MAX_LOADED_MODELS = 2
+WHISPER_COMPUTE_TYPES = ["default", "int8", "int8_float32", "float32", "int8_float16", "float16"]
+WHISPER_GPU_ONLY_COMPUTE_TYPES = {"int8_float16", "float16"}  # CTranslate2 trên CPU không chạy float16
+WHISPER_SETTINGS_FILE = "whisper_config.json"  # Cấu hình nhanh nhất do bench_whisper.py đo trên máy này
+WHISPER_DEFAULT_SETTINGS = {"compute_type": "default", "cpu_threads": 0, "num_workers": 1}
+_whisper_models = OrderedDict()
+_whisper_registry_lock = threading.Lock()
+_whisper_key_locks = {}
+
+
+def load_whisper_settings(path=WHISPER_SETTINGS_FILE):
+    """compute_type / cpu_threads / num_workers mặc định (file do bench_whisper.py ghi, nếu có)."""
+    settings = dict(WHISPER_DEFAULT_SETTINGS)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        settings.update({key: saved[key] for key in WHISPER_DEFAULT_SETTINGS if key in saved})
+    except (OSError, ValueError):
+        pass
+    return settings
+
+
+def save_whisper_settings(settings, path=WHISPER_SETTINGS_FILE):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(settings, f, ensure_ascii=False, indent=2)
+
+
+def whisper_compute_types(device="cpu"):
+    """Các compute_type chạy được trên device ("cpu" hoặc GPU): float16 chỉ có trên GPU."""
+    if device == "cpu":
+        return [t for t in WHISPER_COMPUTE_TYPES if t not in WHISPER_GPU_ONLY_COMPUTE_TYPES]
+    return list(WHISPER_COMPUTE_TYPES)
+
+
+def get_whisper_model(model_name="small", device="cpu", compute_type="default", cpu_threads=0, num_workers=1):
+    """
+    Lấy WhisperModel từ registry, mỗi (model, device, compute_type, cpu_threads, num_workers) chỉ load 1 lần.
+    cpu_threads: số thread CTranslate2 cho mỗi lần transcribe (0 = mặc định).
+    num_workers: số lần transcribe chạy song song trên cùng model (nên = số job whisper chạy cùng lúc).
+    """
+    key = (model_name, device, compute_type, cpu_threads, num_workers)
+    with _whisper_registry_lock:
+        model = _whisper_models.get(key)
+        if model is not None:
+            _whisper_models.move_to_end(key)
+            return model
+        key_lock = _whisper_key_locks.setdefault(key, threading.Lock())
+
+    # Chỉ 1 thread load model, các thread khác chờ và dùng lại
+    with key_lock:
+        with _whisper_registry_lock:
+            model = _whisper_models.get(key)
+            if model is not None:
+                _whisper_models.move_to_end(key)
+                return model
+
+        print(f"🧠 Đang load model whisper: {model_name} ({device}, {compute_type}, "
+              f"{cpu_threads} thread, {num_workers} worker)")
+        model = WhisperModel(model_name, device=device, compute_type=compute_type,
+                             cpu_threads=cpu_threads, num_workers=num_workers)
+
+        with _whisper_registry_lock:
+            _whisper_models[key] = model
+            while len(_whisper_models) > WHISPER_MAX_LOADED_MODELS:
+                old_key, _ = _whisper_models.popitem(last=False)
+                print(f"♻️ Giải phóng model whisper: {old_key}")
+    return model
+
+
+def preload_whisper_model(model_name="small", device="cpu", compute_type="default", cpu_threads=0, num_workers=1):
+    """Load model whisper ở thread nền (ví dụ trong lúc đang tạo voice)."""
+    def worker():
+        try:
+            get_whisper_model(model_name, device, compute_type, cpu_threads, num_workers)
+        except Exception as e:
+            print(f"⚠️ Không thể load trước model whisper {model_name}: {e}")
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    return thread
+
+
 def adjust_srt_time(segments, padding_time=0.5):
     """Điều chỉnh thời gian kết thúc và bắt đầu để tránh trùng lặp trong subtitle và đồng bộ với JSON."""
     adjusted_segments = []
@@ -221,22 +1049,31 @@ def adjust_srt_time(segments, padding_time=0.5):
 
 
 
-def split_text_smart(segment, max_words=6):
-    """Tách đoạn thành nhiều phần nhỏ theo dấu câu và số từ."""
-    text = segment.text.strip()
+SPLIT_PUNCTUATION = [",", ".", "!", "?", ";", ":"]
+SENTENCE_END_PUNCTUATION = [".", "!", "?"]
+
+
+def split_phrases(text):
+    """Tách text thành các cụm theo dấu câu (giữ lại dấu câu ở cuối mỗi cụm)."""
     # Ưu tiên tách theo dấu phẩy, chấm, hoặc xuống dòng
-    split_points = re.split(r'([,.!?;:])', text)
-    
+    split_points = re.split(r'([,.!?;:])', text.strip())
+
     # Gộp lại thành các câu đầy đủ
     phrases = []
     phrase = ""
     for part in split_points:
         phrase += part
-        if part in [",", ".", "!", "?", ";", ":"]:
+        if part in SPLIT_PUNCTUATION:
             phrases.append(phrase.strip())
             phrase = ""
     if phrase:
         phrases.append(phrase.strip())
+    return phrases
+
+
+def split_text_smart(segment, max_words=6):
+    """Tách đoạn thành nhiều phần nhỏ theo dấu câu và số từ."""
+    phrases = split_phrases(segment.text)
 
     # Nếu các câu nhỏ > max_words, tiếp tục tách theo từ
     final_segments = []
@@ -290,58 +1127,366 @@ def split_text_and_timestamps(segment, max_words=6):
 
 
 
-def transcribe_audio(audio_path, folder_path, output_base="output", language_code=None, model_name="small", device="cpu"):
-    """Transcribe audio to text using fast-whisper and generate subtitle files."""
+def segment_word_records(segment, split_parts):
+    """Dữ liệu karaoke (JSON) của 1 segment: từng từ nếu whisper có word timestamps."""
+    records = []
+    if hasattr(segment, "words") and segment.words:
+        for word in segment.words:
+            records.append({
+                "start": word.start,
+                "end": word.end,
+                "text": word.word,
+                "type": "word"
+            })
+    else:
+        for start, end, text, word_data in split_parts:
+            records.extend(word_data)  # Thêm dữ liệu từ cho karaoke
+    return records
 
-    output_dir = folder_path
-    os.makedirs(output_dir, exist_ok=True)
-    model = WhisperModel(model_name, device=device)  # Use dynamic model size and device
 
-    print(f"🧠 Transcribing audio file: {audio_path}")
-    segments_gen, info = model.transcribe(audio_path, language=language_code, word_timestamps=True)
-    segments = list(segments_gen)  # Convert the generator to a list
+# Cache transcript theo nội dung audio: render lại (đổi font, màu, nhạc...) không phải chạy whisper lại
+TRANSCRIPT_CACHE_DIR = os.path.join("cache", "transcripts")
+TRANSCRIPT_CACHE_MAX_BYTES = 100 * 1024 * 1024
+_transcript_cache_stats = {"hit": 0, "miss": 0}
+_transcript_cache_lock = threading.Lock()
+_transcript_key_locks = KeyLocks()
 
-    if not segments:
-        print("❌ No transcriptions available.")
-        return {}
 
-    srt_path = os.path.join(output_dir, f"{output_base}.srt")
-    json_path = os.path.join(output_dir, f"{output_base}.json")
+def transcript_cache_key(audio, model_name, language_code=None, **options):
+    """Hash của (bytes audio, model, ngôn ngữ, tùy chọn ảnh hưởng tới kết quả)."""
+    digest = hashlib.sha256()
+    if isinstance(audio, VoiceAudio):
+        digest.update(f"pcm:{audio.sample_rate}:{audio.sample_width}:{audio.channels}:".encode("utf-8"))
+        digest.update(audio.pcm)
+    else:
+        with open(audio, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    digest.update(json.dumps([model_name, language_code, options], ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
 
-    # Write the SRT file
-    with open(srt_path, "w", encoding="utf-8") as srt_file:
-        idx = 1
+def transcript_key_lock(key):
+    """Các job cùng audio chờ nhau: job đầu chạy whisper, job sau đọc kết quả từ cache."""
+    return _transcript_key_locks.hold(key)
+
+
+def transcript_cache_get(key):
+    """SubtitleTrack từ cache, None nếu miss."""
+    cache_path = os.path.join(TRANSCRIPT_CACHE_DIR, f"{key}.json.gz")
+    try:
+        with gzip.open(cache_path, "rt", encoding="utf-8") as f:
+            track = SubtitleTrack.from_compact(json.load(f))
+        os.utime(cache_path)  # Đánh dấu vừa dùng (LRU)
+    except (OSError, ValueError, KeyError, TypeError):
+        hit = False
+        track = None
+    else:
+        hit = True
+    with _transcript_cache_lock:
+        _transcript_cache_stats["hit" if hit else "miss"] += 1
+    return track
+
+
+def transcript_cache_put(key, track):
+    try:
+        os.makedirs(TRANSCRIPT_CACHE_DIR, exist_ok=True)
+        cache_path = os.path.join(TRANSCRIPT_CACHE_DIR, f"{key}.json.gz")
+        temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        with gzip.open(temp_path, "wt", encoding="utf-8") as f:
+            json.dump(track.to_compact(), f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(temp_path, cache_path)
+        evict_cache_dir(TRANSCRIPT_CACHE_DIR, TRANSCRIPT_CACHE_MAX_BYTES)
+    except OSError as e:
+        print(f"⚠️ Không thể lưu transcript vào cache: {e}")
+
+
+def get_transcript_cache_stats():
+    with _transcript_cache_lock:
+        return dict(_transcript_cache_stats)
+
+
+# Gợi ý cho whisper từ kịch bản đã biết + ghim ngôn ngữ cho cả batch
+WHISPER_PROMPT_CHARS = 400  # initial_prompt chỉ lấy phần đầu kịch bản (whisper giới hạn ~224 token)
+WHISPER_MAX_HOTWORDS = 30
+LANGUAGE_DETECT_SECONDS = 30
+
+
+def script_decode_options(text, prompt_chars=WHISPER_PROMPT_CHARS, max_hotwords=WHISPER_MAX_HOTWORDS):
+    """
+    decode_options cho model.transcribe từ kịch bản: initial_prompt = đầu kịch bản,
+    hotwords = tên riêng / thương hiệu / số (từ viết hoa không đứng đầu câu hoặc có chữ số).
+    """
+    hotwords = []
+    sentence_start = True
+    for word in text.split():
+        clean = word.strip(".,!?;:\"'()[]")
+        if clean and clean not in hotwords and (any(ch.isdigit() for ch in clean) or
+                                                any(ch.isupper() for ch in clean[1:]) or
+                                                (not sentence_start and clean[0].isupper())):
+            hotwords.append(clean)
+        sentence_start = word[-1] in SENTENCE_END_PUNCTUATION
+    options = {"initial_prompt": text[:prompt_chars].strip()}
+    if hotwords:
+        options["hotwords"] = " ".join(hotwords[:max_hotwords])
+    return options
+
+
+def detect_language(audio, model_name="small", device="cpu", compute_type="default", cpu_threads=0, num_workers=1):
+    """Chỉ chạy bước nhận diện ngôn ngữ của whisper trên LANGUAGE_DETECT_SECONDS giây đầu (không decode)."""
+    model = get_whisper_model(model_name, device, compute_type, cpu_threads, num_workers)
+    if isinstance(audio, VoiceAudio):
+        samples = audio.to_whisper_array()
+    else:
+        samples = decode_audio(audio, sampling_rate=WHISPER_SAMPLE_RATE)
+    return detect_language_samples(model, samples)
+
+
+def detect_language_samples(model, samples):
+    """Nhận diện ngôn ngữ trên LANGUAGE_DETECT_SECONDS giây đầu của mảng 16kHz bằng model đã load."""
+    # faster-whisper nhận diện ngôn ngữ ngay trong transcribe(), generator segment không cần chạy
+    _, info = model.transcribe(samples[:int(LANGUAGE_DETECT_SECONDS * WHISPER_SAMPLE_RATE)], language=None)
+    print(f"🗣️ Nhận diện ngôn ngữ: {info.language} ({info.language_probability:.2f})")
+    return info.language
+
+
+class LanguagePin:
+    """Ngôn ngữ dùng chung cho 1 batch "Auto Detect": job đầu tiên nhận diện, các job sau dùng lại."""
+
+    def __init__(self, language_code=None):
+        self.language_code = language_code
+        self._lock = threading.Lock()
+
+    def resolve(self, detect):
+        with self._lock:
+            if self.language_code is None:
+                self.language_code = detect()
+            return self.language_code
+
+
+# Transcribe song song trong 1 file dài: chia tại khoảng lặng thành các chunk chồng lấn nhau
+TRANSCRIBE_CHUNK_SECONDS = 60.0
+TRANSCRIBE_CHUNK_OVERLAP = 2.0  # Giây audio thêm ở 2 bên mỗi chunk để whisper có ngữ cảnh tại điểm cắt
+TRANSCRIBE_PARALLEL_MIN_SECONDS = 120.0  # Audio ngắn hơn thì transcribe 1 lượt như cũ
+
+
+def runs_chunked(audio, chunk_workers):
+    """stream_transcription có thật sự chia chunk song song với audio này không (audio ngắn vẫn chạy 1 lượt)."""
+    if chunk_workers <= 1:
+        return False
+    if isinstance(audio, VoiceAudio):
+        seconds = audio.duration
+    else:
+        try:
+            seconds = float(ffmpeg.probe(audio)["format"]["duration"])
+        except (ffmpeg.Error, OSError, KeyError, ValueError):
+            seconds = len(decode_audio(audio, sampling_rate=WHISPER_SAMPLE_RATE)) / WHISPER_SAMPLE_RATE
+    return seconds >= TRANSCRIBE_PARALLEL_MIN_SECONDS
+
+
+def parallel_segments(model, samples, language_code=None, chunk_workers=4,
+                      chunk_seconds=TRANSCRIBE_CHUNK_SECONDS, overlap=TRANSCRIBE_CHUNK_OVERLAP, decode_options=None):
+    """
+    Transcribe các chunk của mảng 16kHz song song, trả về (generator segment theo timeline chung, info).
+    Mỗi chunk chỉ giữ segment có điểm giữa nằm trong phần lõi của nó -> phần chồng lấn không bị lặp.
+    """
+    total = len(samples)
+    overlap_len = int(overlap * WHISPER_SAMPLE_RATE)
+    spans = split_at_silence(samples, max_seconds=chunk_seconds)
+
+    def run_chunk(core_start, core_end, language):
+        start = max(0, core_start - overlap_len)
+        end = min(total, core_end + overlap_len)
+        offset = start / WHISPER_SAMPLE_RATE
+        segments, chunk_info = model.transcribe(samples[start:end], language=language, word_timestamps=True,
+                                                **(decode_options or {}))
+        owned = []
         for segment in segments:
+            middle = offset + (segment.start + segment.end) / 2
+            if not core_start / WHISPER_SAMPLE_RATE <= middle < core_end / WHISPER_SAMPLE_RATE:
+                continue
+            words = None
+            if getattr(segment, "words", None):
+                words = [SimpleNamespace(start=w.start + offset, end=w.end + offset, word=w.word,
+                                         probability=getattr(w, "probability", None)) for w in segment.words]
+            owned.append(SimpleNamespace(start=segment.start + offset, end=segment.end + offset, text=segment.text,
+                                         words=words, temperature=getattr(segment, "temperature", 0.0)))
+        return owned, chunk_info
+
+    # Chưa chọn ngôn ngữ: chỉ nhận diện trên vài chục giây đầu, rồi mọi chunk chạy song song cùng 1 ngôn ngữ
+    if language_code is None:
+        language_code = detect_language_samples(model, samples)
+    executor = ThreadPoolExecutor(max_workers=chunk_workers)
+    futures = [executor.submit(run_chunk, start, end, language_code) for start, end in spans]
+    executor.shutdown(wait=False)
+
+    def generate():
+        for future in futures:
+            yield from future.result()[0]
+
+    print(f"🧠 Transcribe song song {len(spans)} chunk ({chunk_workers} worker)")
+    return generate(), SimpleNamespace(duration=total / WHISPER_SAMPLE_RATE, language=language_code)
+
+
+def stream_transcription(audio_path, srt_path=None, json_path=None, language_code=None, model_name="small",
+                         device="cpu", compute_type="default", cpu_threads=0, num_workers=1, chunk_workers=1,
+                         decode_options=None):
+    """
+    Đọc generator của faster-whisper từng segment một, ghi nối SRT / JSON (nếu có đường dẫn) ngay khi có segment mới.
+    Yield {"segment", "srt_parts", "words", "progress"} để bên gọi cập nhật tiến độ trong lúc đang decode.
+    chunk_workers > 1: audio dài hơn TRANSCRIBE_PARALLEL_MIN_SECONDS được chia chunk và decode song song.
+    decode_options: tham số thêm cho model.transcribe (initial_prompt, hotwords... xem script_decode_options).
+    """
+    decode_options = decode_options or {}
+    if isinstance(audio_path, VoiceAudio):
+        # PCM đã có sẵn trong RAM -> đưa thẳng mảng 16kHz cho whisper, không decode lại
+        print(f"🧠 Transcribing audio in memory ({audio_path.duration:.2f}s)")
+        audio_input = audio_path.to_whisper_array()
+    else:
+        print(f"🧠 Transcribing audio file: {audio_path}")
+        audio_input = audio_path
+
+    if chunk_workers > 1:
+        # Model phải chạy được chunk_workers lượt cùng lúc. Tăng cả khi audio ngắn (không chia chunk)
+        # để mọi lần gọi cùng cấu hình dùng chung 1 model trong registry, không load thêm bản thứ 2
+        num_workers = max(num_workers, chunk_workers)
+        if isinstance(audio_input, str):
+            audio_input = decode_audio(audio_input, sampling_rate=WHISPER_SAMPLE_RATE)
+        if len(audio_input) < TRANSCRIBE_PARALLEL_MIN_SECONDS * WHISPER_SAMPLE_RATE:
+            chunk_workers = 1
+
+    # Dùng model trong registry chung
+    model = get_whisper_model(model_name, device, compute_type, cpu_threads, num_workers)
+    if chunk_workers > 1:
+        segments_gen, info = parallel_segments(model, audio_input, language_code, chunk_workers,
+                                               decode_options=decode_options)
+    else:
+        segments_gen, info = model.transcribe(audio_input, language=language_code, word_timestamps=True,
+                                              **decode_options)
+
+    srt_file = open(srt_path, "w", encoding="utf-8") if srt_path else None
+    json_file = open(json_path, "w", encoding="utf-8") if json_path else None
+    try:
+        idx = 1
+        word_count = 0
+        if json_file:
+            json_file.write("[")
+        for segment in segments_gen:
             split_parts = split_text_and_timestamps(segment, max_words=5)
-            for start, end, text, word_data in split_parts:
-                srt_file.write(f"{idx}\n")
-                srt_file.write(f"{format_srt_time(start)} --> {format_srt_time(end)}\n")
-                srt_file.write(f"{text}\n\n")
-                idx += 1
-
-    # Save karaoke JSON
-    words_data = []
-    for segment in segments:
-        if hasattr(segment, "words") and segment.words:
-            for word in segment.words:
-                words_data.append({
-                    "start": word.start,
-                    "end": word.end,
-                    "text": word.word,
-                    "type": "word"
-                })
-        else:
-            split_parts = split_text_and_timestamps(segment, max_words=5)
-            for start, end, text, word_data in split_parts:
-                words_data.extend(word_data)  # Thêm dữ liệu từ cho karaoke
+            records = segment_word_records(segment, split_parts)
+
+            if srt_file:
+                for start, end, text, word_data in split_parts:
+                    srt_file.write(f"{idx}\n")
+                    srt_file.write(f"{format_srt_time(start)} --> {format_srt_time(end)}\n")
+                    srt_file.write(f"{text}\n\n")
+                    idx += 1
+                srt_file.flush()
+
+            if json_file:
+                # Ghi từng phần tử của mảng JSON (cùng định dạng với json.dump(..., indent=2))
+                for record in records:
+                    item = json.dumps(record, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+                    json_file.write(f"{',' if word_count else ''}\n  {item}")
+                    word_count += 1
+                json_file.flush()
+
+            yield {
+                "segment": segment,
+                "srt_parts": split_parts,
+                "words": records,
+                "progress": min(1.0, segment.end / info.duration) if info.duration else 0.0,
+                "language": info.language
+            }
+        if json_file:
+            json_file.write("\n]" if word_count else "]")
+    finally:
+        for f in (srt_file, json_file):
+            if f:
+                f.close()
+
 
-    with open(json_path, "w", encoding="utf-8") as json_file:
-        json.dump(words_data, json_file, ensure_ascii=False, indent=2)
+def transcribe_audio(audio_path, folder_path, output_base="output", language_code=None, model_name="small", device="cpu",
+                     compute_type="default", on_segment=None, export_files=True, cpu_threads=0, num_workers=1,
+                     chunk_workers=1, use_cache=True, decode_options=None):
+    """
+    Transcribe audio to text using fast-whisper.
+    Trả về {"subtitles": SubtitleTrack, "srt_path", "karaoke_path"}; 2 file chỉ được ghi khi export_files=True.
+    on_segment(item) được gọi ngay khi mỗi segment được decode xong (xem stream_transcription).
+    compute_type / cpu_threads / num_workers: cấu hình CTranslate2 (xem get_whisper_model, bench_whisper.py).
+    chunk_workers > 1: audio dài được chia chunk và transcribe song song (xem parallel_segments).
+    use_cache: audio đã transcribe (cùng model / ngôn ngữ / tùy chọn) thì lấy từ transcript cache, bỏ qua whisper.
+    decode_options: xem stream_transcription. Kết quả có thêm "language", "seconds" và "fallbacks"
+    (số segment whisper phải decode lại với temperature cao hơn).
+    """
+    if use_cache:
+        # Key theo cách transcribe thật sự chạy: chia chunk song song hay 1 lượt (batched có key riêng)
+        mode = "chunked" if runs_chunked(audio_path, chunk_workers) else "sequential"
+        cache_key = transcript_cache_key(audio_path, model_name, language_code, compute_type=compute_type,
+                                         mode=mode, decode_options=decode_options or {})
+        with transcript_key_lock(cache_key):
+            subtitles = transcript_cache_get(cache_key)
+            if subtitles is None:
+                result = transcribe_audio(audio_path, folder_path, output_base=output_base,
+                                          language_code=language_code, model_name=model_name, device=device,
+                                          compute_type=compute_type, on_segment=on_segment,
+                                          export_files=export_files, cpu_threads=cpu_threads,
+                                          num_workers=num_workers, chunk_workers=chunk_workers,
+                                          use_cache=False, decode_options=decode_options)
+                if result["subtitles"]:
+                    transcript_cache_put(cache_key, result["subtitles"])
+                return result
+
+        print(f"♻️ Dùng lại transcript từ cache ({len(subtitles.lines)} dòng)")
+        srt_path = json_path = None
+        if export_files:
+            os.makedirs(folder_path, exist_ok=True)
+            srt_path = os.path.join(folder_path, f"{output_base}.srt")
+            json_path = os.path.join(folder_path, f"{output_base}.json")
+            subtitles.write_srt(srt_path, format_srt_time)
+            subtitles.write_json(json_path)
+        return {"subtitles": subtitles, "srt_path": srt_path, "karaoke_path": json_path,
+                "language": language_code, "seconds": 0.0, "fallbacks": 0}
+
+    srt_path = json_path = None
+    if export_files:
+        output_dir = folder_path
+        os.makedirs(output_dir, exist_ok=True)
+        srt_path = os.path.join(output_dir, f"{output_base}.srt")
+        json_path = os.path.join(output_dir, f"{output_base}.json")
+
+    subtitles = SubtitleTrack()
+    started = time.time()
+    fallbacks = 0
+    detected_language = language_code
+    for item in stream_transcription(audio_path, srt_path, json_path, language_code=language_code,
+                                     model_name=model_name, device=device, compute_type=compute_type,
+                                     cpu_threads=cpu_threads, num_workers=num_workers,
+                                     chunk_workers=chunk_workers, decode_options=decode_options):
+        subtitles.add_segment(item["srt_parts"], item["words"])
+        detected_language = item["language"]
+        if getattr(item["segment"], "temperature", 0.0):
+            fallbacks += 1  # Segment này phải decode lại (temperature fallback)
+        if on_segment:
+            on_segment(item)
+    stats = {"language": detected_language, "seconds": time.time() - started, "fallbacks": fallbacks}
+
+    if not subtitles:
+        print("❌ No transcriptions available.")
+        for path in (srt_path, json_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+        return {"subtitles": subtitles, "srt_path": None, "karaoke_path": None, **stats}
 
-    print(f"✅ Transcription completed. Files saved to {srt_path} and {json_path}")
+    if export_files:
+        print(f"✅ Transcription completed. Files saved to {srt_path} and {json_path}")
+    else:
+        print(f"✅ Transcription completed. {len(subtitles.lines)} dòng phụ đề")
     return {
+        "subtitles": subtitles,
         "srt_path": srt_path,
-        "karaoke_path": json_path
+        "karaoke_path": json_path,
+        **stats
     }
 
 
@@ -355,6 +1500,16 @@ def format_srt_time(seconds):
 
 # === Subtitle ===
 
+SEQUENTIAL_HIGHLIGHT_MODES = (
+    "Highlight tuần tự (màu chữ)",
+    "Highlight tuần tự (zoom chữ)",
+    "Highlight tuần tự (ô vuông)",
+)
+# 1 Dialogue cho mỗi dòng, từng từ tự đổi màu bằng \t theo thời gian
+# (thay vì 1 Dialogue cho mỗi từ lặp lại cả câu -> file O(k²) và k lần layout lại trong libass)
+ASS_COMPACT_SEQUENTIAL = True
+
+
 def hex_to_ass_color(hex_color: str) -> str:
     """Chuyển mã hex RGB (ví dụ 'FF69B4') sang định dạng màu ASS (&H00BBGGRR)."""
     hex_color = hex_color.strip("#")
@@ -381,14 +1536,47 @@ def generate_karaoke_ass_from_srt_and_words(
     position="dưới",
     base_color="&H00FFFFFF",
     highlight_color="&H00FFFF00",
-    mode="Phụ đề thường (toàn câu)"
+    mode="Phụ đề thường (toàn câu)",
+    compact=None
 ):
-    font = font.replace("-", " ").replace("_", " ")
+    """Tạo .ass từ file .srt + .json (đọc vào SubtitleTrack rồi dùng generate_karaoke_ass)."""
+    subtitles = SubtitleTrack.from_files(srt_path, karaoke_json_path)
+    generate_karaoke_ass(subtitles, output_ass_path, font=font, size=size, position=position,
+                         base_color=base_color, highlight_color=highlight_color, mode=mode, compact=compact)
+
 
-    def convert_srt_time(srt_time):
-        h, m, s = srt_time.split(":")
-        s, ms = s.split(",")
-        return int(h) * 3600 + int(m) * 60 + int(s) + int(ms) / 1000
+def generate_karaoke_ass(
+    subtitles,
+    output_ass_path,
+    font="Roboto",
+    size=14,
+    position="dưới",
+    base_color="&H00FFFFFF",
+    highlight_color="&H00FFFF00",
+    mode="Phụ đề thường (toàn câu)",
+    compact=None
+):
+    """
+    Tạo .ass trực tiếp từ SubtitleTrack trong RAM (không cần đọc lại .srt / .json).
+    compact (mặc định ASS_COMPACT_SEQUENTIAL): các mode highlight tuần tự ghi 1 Dialogue / dòng.
+    """
+    font = font.replace("-", " ").replace("_", " ")
+    if compact is None:
+        compact = ASS_COMPACT_SEQUENTIAL
+    scale_zoom = int(size * 1.3)
+
+    def compact_word(text, on, off):
+        # on / off: ms tính từ đầu Dialogue, từ được highlight trong [on, off)
+        if mode == "Highlight tuần tự (màu chữ)":
+            return (f"{{\\1c{base_color}\\t({on},{on + 1},\\1c{highlight_color})"
+                    f"\\t({off},{off + 1},\\1c{base_color})}}{text}")
+        if mode == "Highlight tuần tự (zoom chữ)":
+            return (f"{{\\1c{base_color}\\fs{size}\\t({on},{on + 1},\\1c{highlight_color})"
+                    f"\\t({on},{on + 100},\\fs{scale_zoom})\\t({on + 100},{on + 300},\\fs{size})"
+                    f"\\t({off},{off + 1},\\1c{base_color})}}{text}")
+        return (f"{{\\1c{base_color}\\bord0\\shad0\\3c&H000000&"
+                f"\\t({on},{on + 1},\\1c{highlight_color}\\bord2)"
+                f"\\t({off},{off + 1},\\1c{base_color}\\bord0)}}{text}")
 
     def format_ass_time(seconds):
         h = int(seconds // 3600)
@@ -397,25 +1585,7 @@ def generate_karaoke_ass_from_srt_and_words(
         cs = int((seconds % 1) * 100)
         return f"{h}:{m:02}:{s:02}.{cs:02}"
 
-    with open(karaoke_json_path, "r", encoding="utf-8") as f:
-        word_items = [w for w in json.load(f) if w.get("type") == "word"]
-
-    def parse_srt(file_path):
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        blocks = re.split(r'\n\s*\n', content.strip())
-        segments = []
-        for block in blocks:
-            lines = block.strip().split('\n')
-            if len(lines) >= 3:
-                time_line = lines[1]
-                text = ' '.join(lines[2:])
-                match = re.match(r'(\d{2}:\d{2}:\d{2},\d{3})\s*-->\s*(\d{2}:\d{2}:\d{2},\d{3})', time_line)
-                if match:
-                    start = convert_srt_time(match.group(1))
-                    end = convert_srt_time(match.group(2))
-                    segments.append({"start": start, "end": end, "text": text})
-        return segments
+    word_index = subtitles.karaoke_index()
 
     alignment_map = {
         "trên": 8,
@@ -429,7 +1599,7 @@ def generate_karaoke_ass_from_srt_and_words(
     output_dir = os.path.dirname(output_ass_path)
     os.makedirs(output_dir, exist_ok=True)
 
-    segments = parse_srt(srt_path)
+    segments = subtitles.lines
 
     with open(output_ass_path, "w", encoding="utf-8") as f:
         # Header
@@ -444,31 +1614,23 @@ def generate_karaoke_ass_from_srt_and_words(
         f.write("[Events]\n")
         f.write("Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n")
 
-        word_idx = 0
         for seg in segments:
-            seg_start = seg["start"]
-            seg_end = seg["end"]
+            seg_start = seg.start
+            seg_end = seg.end
             ass_start = format_ass_time(seg_start)
             ass_end = format_ass_time(seg_end)
-            full_text = seg["text"]
-
-            # Lấy các từ thuộc đoạn
-            line_words = []
-            temp_idx = word_idx
-            while temp_idx < len(word_items):
-                w = word_items[temp_idx]
-                if w["end"] <= seg_start:
-                    temp_idx += 1
-                    continue
-                if w["start"] >= seg_end:
-                    break
-                line_words.append({
-                    "start": w["start"],
-                    "end": w["end"],
-                    "text": w["text"].replace("{", "").replace("}", ""),
-                    "dur": int((w["end"] - w["start"]) * 100)
-                })
-                temp_idx += 1
+            full_text = seg.text
+
+            # Lấy các từ thuộc đoạn (bisect trên chỉ mục thời gian, không quét lại từ đầu)
+            line_words = [
+                {
+                    "start": w.start,
+                    "end": w.end,
+                    "text": w.text.replace("{", "").replace("}", ""),
+                    "dur": int((w.end - w.start) * 100)
+                }
+                for w in word_index.between(seg_start, seg_end)
+            ]
 
             # Ghi phụ đề theo mode
             if mode == "Phụ đề thường (toàn câu)":
@@ -479,6 +1641,20 @@ def generate_karaoke_ass_from_srt_and_words(
                 ass_line = "".join([f"{{\\k{w['dur']}}}{w['text']}" for w in line_words])
                 f.write(f"Dialogue: 0,{ass_start},{ass_end},Highlight,,0,0,0,,{ass_line}\n")
 
+            elif compact and mode in SEQUENTIAL_HIGHLIGHT_MODES:
+                if not line_words:
+                    continue
+                # Mốc thời gian của \t tính theo ms từ đầu event (đã làm tròn xuống centisecond như format_ass_time)
+                event_start = int(line_words[0]["start"] * 100) / 100
+                ass_line = ""
+                for w in line_words:
+                    on = max(0, int(round((w["start"] - event_start) * 1000)))
+                    off = max(on + 1, int(round((w["end"] - event_start) * 1000)))
+                    ass_line += compact_word(w["text"], on, off)
+                start = format_ass_time(line_words[0]["start"])
+                end = format_ass_time(line_words[-1]["end"])
+                f.write(f"Dialogue: 0,{start},{end},Highlight,,0,0,0,,{ass_line.strip()}\n")
+
             elif mode == "Highlight tuần tự (màu chữ)":
                 for i, _ in enumerate(line_words):
                     ass_line = "".join([
@@ -494,7 +1670,7 @@ def generate_karaoke_ass_from_srt_and_words(
                     ass_line = "".join([
                         (
                             f"{{\\1c{highlight_color}\\fs{size}"
-                            f"\\t(0,100,\\fs{int(size * 1.3)})"
+                            f"\\t(0,100,\\fs{scale_zoom})"
                             f"\\t(100,300,\\fs{size})}}{w['text']}"
                             if j == i else f"{{\\1c{base_color}\\fs{size}}}{w['text']}"
                         )
@@ -517,14 +1693,15 @@ def generate_karaoke_ass_from_srt_and_words(
                     end = format_ass_time(line_words[i]["end"])
                     f.write(f"Dialogue: 0,{start},{end},Highlight,,0,0,0,,{ass_line.strip()}\n")
 
-            elif mode == "Hiệu ứng từng chữ một (chuyên sâu)":
-                for w in word_items:
-                    w_start = format_ass_time(w["start"])
-                    w_end = format_ass_time(w["end"])
-                    scale_up = int(size * 1.2)
-                    effect = f"{{\\fad(100,100)\\fs{size}\\t(0,200,\\fs{scale_up})}}{w['text']}"
-                    f.write(f"Dialogue: 0,{w_start},{w_end},Highlight,,0,0,0,,{effect}\n")
-
-    word_idx = temp_idx
+        if mode == "Hiệu ứng từng chữ một (chuyên sâu)" and segments:
+            # Mỗi từ ghi đúng 1 lần theo thời gian của chính nó (trước đây toàn bộ từ bị ghi lại ở mỗi dòng).
+            # Event không phụ thuộc dòng nên không lọc theo dòng: từ lệch ra ngoài mọi dòng
+            # (vd. mốc .srt làm tròn giây) vẫn được ghi
+            scale_up = int(size * 1.2)
+            for w in word_index.words:
+                w_start = format_ass_time(w.start)
+                w_end = format_ass_time(w.end)
+                effect = f"{{\\fad(100,100)\\fs{size}\\t(0,200,\\fs{scale_up})}}{w.text}"
+                f.write(f"Dialogue: 0,{w_start},{w_end},Highlight,,0,0,0,,{effect}\n")
 
     print(f"✅ Đã tạo phụ đề .ass ({mode}): {output_ass_path}")
\ No newline at end of file